@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+""" Benchmark of pure-Python overhead of resolving package collections.
+
+Packages of synthetic graphs have no-op toolsets, like
+example/basic/exccpkgfile_dummy.py, so only collecting, dependency
+resolution and scheduling are measured. Each graph is generated as a tree of
+exccpkgfile.py files under a temporary directory, nested by
+add_dependency_collection and add_submodule the same way as real projects.
+
+Usage:
+    python benchmark/bench_resolve.py --output results.json
+    python benchmark/bench_resolve.py --baseline results.json
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import logging
+from pathlib import Path
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from exccpkg import exccpkg
+
+# Stages measured for each graph, in the order resolve runs them.
+STAGES = ("collect", "check_conflictions", "filter_pkgs", "resolve")
+
+
+class Toolset:
+    """ Toolset doing nothing. """
+    def grab(self, pkg_name: str) -> Path:
+        return Path("src_dir")
+
+    def build(self, src_dir: Path) -> Path:
+        return Path("build_dir")
+
+    def install(self, build_dir: Path) -> None:
+        pass
+
+
+class Context(exccpkg.Context):
+    def __init__(self, state_dir: Path) -> None:
+        self.toolset = Toolset()
+        self.state_dir = state_dir
+
+
+def _class_source(name: str, version: str, depends: Optional[List[str]], src_dir: Optional[Path]) -> str:
+    """ Source of a package class, grabbing src_dir if it is a submodule. """
+    grab = f"Path({str(src_dir)!r})" if src_dir is not None else "ctx.toolset.grab(self.name)"
+    return f'''
+class {_class_name(name)}(exccpkg.Package):
+    name = {name!r}
+    version = {version!r}
+    depends = {depends!r}
+
+    def grab(self, ctx):
+        return {grab}
+
+    def build(self, ctx, src_dir):
+        return ctx.toolset.build(src_dir)
+
+    def install(self, ctx, build_dir):
+        ctx.toolset.install(build_dir)
+'''
+
+
+def _class_name(name: str) -> str:
+    return "Package_" + name.replace("-", "_")
+
+
+def _write_exccpkgfile(
+    project_dir: Path, pkgs: List[Tuple[str, List[str]]],
+    dep_pkgs: Sequence[List[Tuple[str, List[str]]]] = (),
+    submodules: Sequence[Tuple[str, Path]] = ()
+) -> Path:
+    """ Write exccpkgfile.py of a generated project.
+
+    Args:
+        pkgs: Name and depends of packages of the project.
+        dep_pkgs: Packages of each dependency collection, nested in order,
+            each one added to the previous.
+        submodules: Name and project directory of submodules.
+    """
+    lines = ["# Generated by benchmark/bench_resolve.py.", "from pathlib import Path", "",
+             "from exccpkg import exccpkg", ""]
+    for name, depends in pkgs + [pkg for level in dep_pkgs for pkg in level]:
+        lines.append(_class_source(name, "1.0", depends, None))
+    for name, src_dir in submodules:
+        lines.append(_class_source(name, "1.0", None, src_dir))
+    lines.append("")
+    lines.append("def collect(ctx):")
+    lines.append(f"    collection = exccpkg.PackageCollection({_instances(pkgs)})")
+    parent = "collection"
+    for i, level in enumerate(dep_pkgs):
+        lines.append(f"    dep_collection_{i} = exccpkg.PackageCollection({_instances(level)})")
+        lines.append(f"    {parent}.add_dependency_collection(dep_collection_{i})")
+        parent = f"dep_collection_{i}"
+    for name, _ in submodules:
+        lines.append(f"    collection.add_submodule(ctx, {_class_name(name)}())")
+    lines.append("    return collection")
+    project_dir.mkdir(parents=True, exist_ok=True)
+    path = project_dir / "exccpkgfile.py"
+    path.write_text("\n".join(lines) + "\n")
+    return path
+
+
+def _instances(pkgs: List[Tuple[str, List[str]]]) -> str:
+    return "[" + ", ".join(f"{_class_name(name)}()" for name, _ in pkgs) + "]"
+
+
+def generate_wide(root: Path, width: int) -> Path:
+    """ width applications each depending on a library of its own, in a
+    single dependency collection. """
+    apps = [(f"wide-app-{i}", [f"wide-lib-{i}"]) for i in range(width)]
+    libs = [(f"wide-lib-{i}", []) for i in range(width)]
+    return _write_exccpkgfile(root / "wide", apps, [libs])
+
+
+def generate_deep(root: Path, depth: int) -> Path:
+    """ Chain of depth packages, each one a submodule of the previous, with a
+    nested dependency collection. """
+    for i in reversed(range(depth)):
+        depends = [f"deep-{i + 1}"] if i + 1 < depth else ["deep-leaf"]
+        submodules = [(f"deep-{i + 1}", root / "deep" / str(i + 1))] if i + 1 < depth else []
+        # Leaf package repeated in every level, resolved as a single one.
+        path = _write_exccpkgfile(root / "deep" / str(i), [(f"deep-{i}", depends)],
+                                  [[("deep-leaf", [])]], submodules)
+    return path
+
+
+def generate_diamond(root: Path, width: int, shared: int) -> Path:
+    """ A top package depending on width submodules, which all depend on the
+    same submodule of shared packages. """
+    base_dir = root / "diamond" / "base"
+    _write_exccpkgfile(base_dir, [(f"diamond-base-{i}", []) for i in range(shared)])
+    base_names = [f"diamond-base-{i}" for i in range(shared)]
+    mids = []
+    for i in range(width):
+        mid_dir = root / "diamond" / f"mid-{i}"
+        _write_exccpkgfile(mid_dir, [(f"diamond-mid-{i}", base_names)],
+                           submodules=[("diamond-base", base_dir)])
+        mids.append((f"diamond-mid-{i}", mid_dir))
+    return _write_exccpkgfile(root / "diamond" / "top",
+                              [("diamond-top", [name for name, _ in mids])], submodules=mids)
+
+
+def collect(ctx: Context, exccpkgfile: Path) -> exccpkg.PackageCollection:
+    """ Import generated exccpkgfile.py and collect, as a project does. """
+    module_name = f"bench_{exccpkgfile.parent.name}"
+    spec = importlib.util.spec_from_file_location(module_name, exccpkgfile)
+    module = importlib.util.module_from_spec(spec)
+    # Required by inspect to find source of package classes.
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module.collect(ctx)
+
+
+def count_instances(collection: exccpkg.PackageCollection) -> int:
+    """ Number of package instances in collection tree, duplicates included. """
+    return (len(collection._PackageCollection__pkgs)
+            + sum(count_instances(sub) for sub in collection._PackageCollection__sub_collections))
+
+
+def _timed(func: Callable[[], Any]) -> Tuple[float, Any]:
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def bench_graph(exccpkgfile: Path, state_dir: Path, repeat: int, jobs: int) -> Dict[str, Any]:
+    """ Time each stage repeat times, on a freshly collected tree each time. """
+    ctx = Context(state_dir)
+    times: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    instances, packages = 0, 0
+    for _ in range(repeat):
+        duration, collection = _timed(lambda: collect(ctx, exccpkgfile))
+        times["collect"].append(duration)
+        instances = count_instances(collection)
+        duration, _ = _timed(collection._PackageCollection__check_conflictions)
+        times["check_conflictions"].append(duration)
+        collection._PackageCollection__set_depth(0)
+        duration, depth_pkgs = _timed(collection._PackageCollection__filter_pkgs)
+        times["filter_pkgs"].append(duration)
+        packages = len(depth_pkgs)
+        collection = collect(ctx, exccpkgfile)
+        duration, _ = _timed(lambda: collection.resolve(ctx, jobs=jobs))
+        times["resolve"].append(duration)
+    return {
+        "packages": packages,
+        "instances": instances,
+        "stages": {stage: {"min": min(values), "median": statistics.median(values),
+                           "mean": statistics.fmean(values)}
+                   for stage, values in times.items()},
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """ Stages whose median time exceeds baseline by more than tolerance
+    times, as messages. """
+    regressions = []
+    for graph, result in results["graphs"].items():
+        if graph not in baseline["graphs"]:
+            continue
+        for stage, stats in result["stages"].items():
+            base = baseline["graphs"][graph]["stages"].get(stage)
+            if base is None or base["median"] <= 0:
+                continue
+            ratio = stats["median"] / base["median"]
+            if ratio > tolerance:
+                regressions.append(f"{graph}.{stage}: {base['median'] * 1000:.2f}ms -> "
+                                   f"{stats['median'] * 1000:.2f}ms ({ratio:.2f}x)")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--graphs", nargs="+", choices=["wide", "deep", "diamond"],
+                        default=["wide", "deep", "diamond"])
+    parser.add_argument("--width", type=int, default=300, help="Applications of wide graph.")
+    parser.add_argument("--depth", type=int, default=100, help="Levels of deep graph.")
+    parser.add_argument("--diamond-width", type=int, default=50, help="Submodules of diamond graph.")
+    parser.add_argument("--diamond-shared", type=int, default=20,
+                        help="Packages shared by all submodules of diamond graph.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--jobs", type=int, default=1, help="Jobs of end-to-end resolve.")
+    parser.add_argument("--output", type=Path, help="Write JSON results to file instead of stdout.")
+    parser.add_argument("--baseline", type=Path, help="JSON results to compare medians with.")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="Max ratio of median to baseline before failing.")
+    args = parser.parse_args(argv)
+    # Resolve logs every package, keep it out of measurements.
+    logging.basicConfig(level=logging.WARNING)
+
+    params = {
+        "wide": {"width": args.width},
+        "deep": {"depth": args.depth},
+        "diamond": {"width": args.diamond_width, "shared": args.diamond_shared},
+    }
+    results: Dict[str, Any] = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "repeat": args.repeat,
+        "jobs": args.jobs,
+        "graphs": dict(),
+    }
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), args.depth * 10))
+    with tempfile.TemporaryDirectory(prefix="exccpkg-bench-") as tmp_dir:
+        root = Path(tmp_dir)
+        generators = {
+            "wide": lambda: generate_wide(root, args.width),
+            "deep": lambda: generate_deep(root, args.depth),
+            "diamond": lambda: generate_diamond(root, args.diamond_width, args.diamond_shared),
+        }
+        for graph in args.graphs:
+            exccpkgfile = generators[graph]()
+            result = bench_graph(exccpkgfile, root / "state" / graph, args.repeat, args.jobs)
+            results["graphs"][graph] = {"params": params[graph], **result}
+            stages = " ".join(f"{stage}={stats['median'] * 1000:.2f}ms"
+                              for stage, stats in result["stages"].items())
+            print(f"{graph}: packages={result['packages']} instances={result['instances']} {stages}",
+                  file=sys.stderr)
+
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        args.output.write_text(text + "\n")
+    else:
+        print(text)
+    if args.baseline is not None:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"Regression {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
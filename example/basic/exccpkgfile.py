@@ -1,6 +1,5 @@
 from collections import defaultdict
 import logging
-from multiprocessing import cpu_count
 import os
 from pathlib import Path
 import platform
@@ -77,18 +76,19 @@ class CMakeCommon:
     def __init__(self, cfg: Config):
         self.cfg = cfg
 
-    def download(self, url: str, pkg_name: str, ext: str, unpack_dir: str = "") -> Path:
+    def download(self, url: str, pkg_name: str, ext: str, unpack_dir: str = "",
+                 sha256: str | None = None,
+                 downloader: tools.Downloader | None = None) -> Path:
         package_path = self.cfg.download_dir / f"{pkg_name}{ext}"
         src_path = self.cfg.deps_dir / pkg_name
         # Setup proxy.
         # if urlparse(url).hostname == "github.com":
         #     # For machines reside in Chinese mainland.
         #     url = "https://www.ghproxy.cn/" + url
-        tools.download(url, package_path, self.cfg.dryrun)
-        if unpack_dir == "":
-            tools.unpack(package_path, self.cfg.deps_dir, self.cfg.dryrun)
-        else:
-            tools.unpack(package_path, self.cfg.deps_dir / unpack_dir, self.cfg.dryrun)
+        unpack_path = self.cfg.deps_dir / unpack_dir
+        # Extract tarballs while downloading, the archive is kept for reruns.
+        tools.download_unpack(url, package_path, unpack_path, self.cfg.dryrun,
+                              downloader=downloader, sha256=sha256)
         return src_path
     
     def build(self, src_dir: Path, cmake_options: str = "") -> Path:
@@ -97,31 +97,37 @@ class CMakeCommon:
         tools.run_cmd(f"""cmake {self.cfg.cmake_common} {cmake_options}
                                 -G "{self.cfg.generator}" -S {src_dir}
                                 -B {build_dir}""", self.cfg.dryrun)
-        tools.run_cmd(f"""cmake --build {build_dir}
-                                --config={self.cfg.cmake_build_type}
-                                --parallel={cpu_count()}""", self.cfg.dryrun)
+        # Under a jobserver, make, and ninja with fifo auth, take jobs from it.
+        jobs = tools.parallel_jobs(self.cfg.generator)
+        parallel = [f"--parallel={jobs}"] if jobs else []
+        tools.run_cmd(["cmake", "--build", build_dir,
+                       f"--config={self.cfg.cmake_build_type}", *parallel], self.cfg.dryrun)
         return build_dir
     
     def install(self, build_dir: Path) -> None:
-        tools.run_cmd(f"""cmake --install {build_dir}
-                                --config={self.cfg.cmake_build_type}
-                                --prefix={self.cfg.install_dir}""", self.cfg.dryrun)
+        tools.run_cmd(["cmake", "--install", build_dir,
+                       f"--config={self.cfg.cmake_build_type}",
+                       f"--prefix={tools.install_prefix(self.cfg.install_dir)}"], self.cfg.dryrun)
 
 
 class Context(exccpkg.Context):
     def __init__(self):
         self.cfg = Config()
         self.cmake = CMakeCommon(self.cfg)
+        self.state_dir = self.cfg.deps_dir / ".exccpkg"
+        self.install_dir = self.cfg.install_dir
 
 
 class AbseilCpp(exccpkg.Package):
     name = "abseil-cpp"
     version = "20240722.0"
+    sha256 = "f50e5ac311a81382da7fa75b97310e4b9006474f9560ac46f54a9967f07d4ae3"
 
     @override
     def grab(self, ctx: Context) -> Path:
         url = "https://github.com/abseil/abseil-cpp/archive/refs/tags/20240722.0.tar.gz"
-        return ctx.cmake.download(url, "abseil-cpp-20240722.0", ".tar.gz")
+        return ctx.cmake.download(url, "abseil-cpp-20240722.0", ".tar.gz", sha256=self.sha256,
+                                  downloader=ctx.downloader)
 
     @override
     def build(self, ctx: Context, src_dir: Path) -> Path:
@@ -135,16 +141,19 @@ class AbseilCpp(exccpkg.Package):
 class NlohmannJson(exccpkg.Package):
     name = "nlohmann-json"
     version = "3.11.3"
+    sha256 = "9bea4c8066ef4a1c206b2be5a36302f8926f7fdc6087af5d20b417d0cf103ea6"
 
     @override
     def grab(self, ctx: Context) -> Path:
         url = "https://github.com/nlohmann/json/releases/download/v3.11.3/json.hpp"
         download_path = ctx.cfg.download_dir / "nlohmann-json-3.11.3.hpp"
-        tools.download(url, download_path, ctx.cfg.dryrun)
+        tools.download(url, download_path, ctx.cfg.dryrun, downloader=ctx.downloader,
+                       sha256=self.sha256)
         output_dir = ctx.cfg.deps_dir / "nlohmann-json-3.11.3"
         tools.mkdirp(output_dir, ctx.cfg.dryrun)
         if not ctx.cfg.dryrun:
-            shutil.copy(download_path, output_dir)
+            # Keep mtime of unchanged file, so dependents are not rebuilt.
+            tools.sync_file(download_path, output_dir / download_path.name)
         return output_dir
 
     @override
@@ -154,7 +163,7 @@ class NlohmannJson(exccpkg.Package):
     
     @override
     def install(self, ctx: Context, build_dir: Path) -> None:
-        install_dir = ctx.cfg.install_dir / "include/nlohmann"
+        install_dir = tools.install_prefix(ctx.cfg.install_dir) / "include/nlohmann"
         tools.mkdirp(install_dir, ctx.cfg.dryrun)
         if not ctx.cfg.dryrun:
             shutil.copy(build_dir / "nlohmann-json-3.11.3.hpp", install_dir / "json.hpp")
@@ -1,6 +1,5 @@
 from collections import defaultdict
 import logging
-from multiprocessing import cpu_count
 import os
 from pathlib import Path
 import platform
@@ -75,10 +74,12 @@ class CMakeCommon:
     def __init__(self, cfg: Config):
         self.cfg = cfg
 
-    def download(self, url: str, pkg_name: str, ext: str, unpack_dir: str = "") -> Path:
+    def download(self, url: str, pkg_name: str, ext: str, unpack_dir: str = "",
+                 sha256: str | None = None,
+                 downloader: tools.Downloader | None = None) -> Path:
         package_path = self.cfg.download_dir / f"{pkg_name}{ext}"
         src_path = self.cfg.deps_dir / pkg_name
-        tools.download(url, package_path, self.cfg.dryrun)
+        tools.download(url, package_path, self.cfg.dryrun, downloader=downloader, sha256=sha256)
         if unpack_dir == "":
             tools.unpack(package_path, self.cfg.deps_dir, self.cfg.dryrun)
         else:
@@ -91,15 +92,17 @@ class CMakeCommon:
         tools.run_cmd(f"""cmake {self.cfg.cmake_common} {cmake_options}
                                 -G "{self.cfg.generator}" -S {src_dir}
                                 -B {build_dir}""", self.cfg.dryrun)
-        tools.run_cmd(f"""cmake --build {build_dir}
-                                --config={self.cfg.cmake_build_type}
-                                --parallel={cpu_count()}""", self.cfg.dryrun)
+        # Under a jobserver, make, and ninja with fifo auth, take jobs from it.
+        jobs = tools.parallel_jobs(self.cfg.generator)
+        parallel = [f"--parallel={jobs}"] if jobs else []
+        tools.run_cmd(["cmake", "--build", build_dir,
+                       f"--config={self.cfg.cmake_build_type}", *parallel], self.cfg.dryrun)
         return build_dir
     
     def install(self, build_dir: Path) -> None:
-        tools.run_cmd(f"""cmake --install {build_dir}
-                                --config={self.cfg.cmake_build_type}
-                                --prefix={self.cfg.install_dir}""", self.cfg.dryrun)
+        tools.run_cmd(["cmake", "--install", build_dir,
+                       f"--config={self.cfg.cmake_build_type}",
+                       f"--prefix={tools.install_prefix(self.cfg.install_dir)}"], self.cfg.dryrun)
 
 
 class Context(exccpkg.Context):
@@ -111,11 +114,13 @@ class Context(exccpkg.Context):
 class AbseilCpp(exccpkg.Package):
     name = "abseil-cpp"
     version = "20240722.0"
+    sha256 = "f50e5ac311a81382da7fa75b97310e4b9006474f9560ac46f54a9967f07d4ae3"
 
     @override
     def grab(self, ctx: Context) -> Path:
         url = "https://github.com/abseil/abseil-cpp/archive/refs/tags/20240722.0.tar.gz"
-        return ctx.cmake.download(url, "abseil-cpp-20240722.0", ".tar.gz")
+        return ctx.cmake.download(url, "abseil-cpp-20240722.0", ".tar.gz", sha256=self.sha256,
+                                  downloader=ctx.downloader)
 
     @override
     def build(self, ctx: Context, src_dir: Path) -> Path:
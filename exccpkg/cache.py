@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import logging
+import os
+from pathlib import Path
+import platform
+import shutil
+import tarfile
+import tempfile
+import threading
+from typing import Callable, List, Optional, Protocol, Tuple
+import zlib
+
+import requests
+
+from exccpkg import tools
+
+
+def default_cache_dir() -> Path:
+    """ User level cache directory, overridden by EXCCPKG_CACHE_DIR. """
+    if "EXCCPKG_CACHE_DIR" in os.environ:
+        return Path(os.environ["EXCCPKG_CACHE_DIR"])
+    if platform.system() == "Windows" and "LOCALAPPDATA" in os.environ:
+        return Path(os.environ["LOCALAPPDATA"]) / "exccpkg"
+    if "XDG_CACHE_HOME" in os.environ:
+        return Path(os.environ["XDG_CACHE_HOME"]) / "exccpkg"
+    return Path.home() / ".cache" / "exccpkg"
+
+
+class DownloadCache:
+    """ Download cache shared by all projects of current user.
+
+    Files are keyed by sha256 of content if known, otherwise by url. Hits are
+    handed to projects by hardlink or reflink, falling back to copy. Least
+    recently used files are evicted when total size exceeds max_size.
+    """
+    def __init__(self, root: Optional[Path] = None, max_size: int = 20 * 1024 ** 3) -> None:
+        """
+        Args:
+            root: Cache directory, default_cache_dir()/downloads if not provided.
+            max_size: Max total size of cached files in bytes.
+        """
+        self.root = root if root is not None else default_cache_dir() / "downloads"
+        self.max_size = max_size
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(url: str, sha256: Optional[str] = None) -> str:
+        if sha256:
+            return f"sha256-{sha256.lower()}"
+        return f"url-{hashlib.sha256(url.encode()).hexdigest()}"
+
+    def get(self, url: str, file_path: Path, sha256: Optional[str] = None) -> bool:
+        """ Link cached file to file_path, return False on miss. """
+        obj_path = self.__obj_path(url, sha256)
+        if not obj_path.exists():
+            return False
+        logging.info(f"Download cache hit: {url} -> {obj_path}")
+        tools.link_file(obj_path, file_path)
+        self.__touch(obj_path)
+        return True
+
+    def put(self, url: str, file_path: Path, sha256: Optional[str] = None) -> None:
+        """ Add downloaded file to cache. Raise if sha256 mismatches. """
+        if sha256:
+            tools.verify_sha256(file_path, sha256)
+        obj_path = self.__obj_path(url, sha256)
+        obj_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = obj_path.with_name(f"{obj_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tools.link_file(file_path, tmp_path)
+        os.replace(tmp_path, obj_path)
+        self.__touch(obj_path)
+        self.evict()
+
+    def evict(self) -> None:
+        """ Remove least recently used files until total size fits max_size. """
+        with self.__lock:
+            entries: List[Tuple[float, int, Path]] = []
+            total = 0
+            for obj_path in self.__objs_dir().glob("*"):
+                if obj_path.suffix in (".used", ".tmp"):
+                    continue
+                try:
+                    size = obj_path.stat().st_size
+                    used_path = obj_path.with_name(obj_path.name + ".used")
+                    used = used_path.stat().st_mtime if used_path.exists() else 0
+                except FileNotFoundError:
+                    continue
+                entries.append((used, size, obj_path))
+                total += size
+            for _, size, obj_path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                logging.info(f"Download cache evict: {obj_path}")
+                obj_path.unlink(missing_ok=True)
+                obj_path.with_name(obj_path.name + ".used").unlink(missing_ok=True)
+                total -= size
+
+    def __objs_dir(self) -> Path:
+        return self.root / "objects"
+
+    def __obj_path(self, url: str, sha256: Optional[str]) -> Path:
+        return self.__objs_dir() / self.key(url, sha256)
+
+    @staticmethod
+    def __touch(obj_path: Path) -> None:
+        # Record access time in a separate file, touching the cached file
+        # itself changes mtime of all its hardlinks.
+        obj_path.with_name(obj_path.name + ".used").touch()
+
+
+class ArtifactStore(Protocol):
+    """ Storage of artifact archives. """
+    def get(self, key: str, file_path: Path) -> bool:
+        """ Fetch artifact to file_path, return False if not found. """
+        ...
+
+    def put(self, key: str, file_path: Path) -> None:
+        """ Save artifact from file_path. """
+        ...
+
+
+class LocalArtifactStore:
+    """ Artifacts in a directory, which can be on a shared filesystem. """
+    def __init__(self, root: Optional[Path] = None) -> None:
+        self.root = root if root is not None else default_cache_dir() / "artifacts"
+
+    def get(self, key: str, file_path: Path) -> bool:
+        obj_path = self.root / f"{key}.tar.gz"
+        if not obj_path.exists():
+            return False
+        tools.link_file(obj_path, file_path)
+        return True
+
+    def put(self, key: str, file_path: Path) -> None:
+        obj_path = self.root / f"{key}.tar.gz"
+        obj_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = obj_path.with_name(f"{obj_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tools.link_file(file_path, tmp_path)
+        os.replace(tmp_path, obj_path)
+
+
+class HttpArtifactStore:
+    """ Artifacts on a HTTP server supporting GET and PUT, like a WebDAV share.
+
+    A .sha256 file is uploaded next to each artifact, fetched artifacts are
+    verified against it if present.
+    """
+    def __init__(self, base_url: str, downloader: Optional[tools.Downloader] = None) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.downloader = downloader if downloader is not None else tools.default_downloader()
+
+    def get(self, key: str, file_path: Path) -> bool:
+        """ Download artifact, False if missing, truncated or mismatching its
+        digest. file_path is only written on success. """
+        url = f"{self.base_url}/{key}.tar.gz"
+        part_path = file_path.with_name(file_path.name + ".part")
+        digest = hashlib.sha256()
+        received = 0
+        try:
+            with self.downloader.get(url) as resp:
+                if resp.status_code == 404:
+                    return False
+                resp.raise_for_status()
+                total_length = resp.headers.get("content-length")
+                with open(part_path, "wb") as fs:
+                    for data in resp.iter_content(chunk_size=self.downloader.chunk_size):
+                        fs.write(data)
+                        digest.update(data)
+                        received += len(data)
+            if total_length is not None and received != int(total_length):
+                logging.warning(f"Incomplete artifact={key}, got {received} of {total_length} bytes")
+                return False
+            expected = self.__get_text(f"{url}.sha256")
+            if expected is not None and expected.strip().lower() != digest.hexdigest():
+                logging.warning(f"Hash mismatch artifact={key} expect={expected.strip()} "
+                                f"got={digest.hexdigest()}")
+                return False
+            os.replace(part_path, file_path)
+            return True
+        finally:
+            part_path.unlink(missing_ok=True)
+
+    def put(self, key: str, file_path: Path) -> None:
+        url = f"{self.base_url}/{key}.tar.gz"
+        with open(file_path, "rb") as fs:
+            resp = self.downloader.session.put(url, data=fs, timeout=self.downloader.timeout)
+        resp.raise_for_status()
+        resp = self.downloader.session.put(
+            f"{url}.sha256", data=tools.file_sha256(file_path).encode(), timeout=self.downloader.timeout)
+        resp.raise_for_status()
+
+    def __get_text(self, url: str) -> Optional[str]:
+        """ Small file on server, None if not found. """
+        resp = self.downloader.session.get(url, timeout=self.downloader.timeout)
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.text
+
+
+class ArtifactCache:
+    """ Cache of installed files of packages.
+
+    Artifacts are keyed by package id and fingerprint, which covers sources,
+    configuration and dependencies, see Package.fingerprint. Capturing requires
+    Package.install to install into tools.install_prefix.
+    """
+    def __init__(self, store: ArtifactStore, install_dir: Path) -> None:
+        """
+        Args:
+            store: Where artifacts are saved, like LocalArtifactStore.
+            install_dir: Prefix that packages are installed into.
+        """
+        self.store = store
+        self.install_dir = install_dir
+
+    def restore(self, key: str) -> bool:
+        """ Extract artifact into install_dir, return False on miss. Files of
+        the same content in install_dir are kept. """
+        with tempfile.TemporaryDirectory(prefix="exccpkg-stage-") as tmp_dir:
+            if not self.fetch(key, Path(tmp_dir)):
+                return False
+            tools.sync_tree(Path(tmp_dir), self.install_dir)
+        return True
+
+    def install(self, key: str, install: Callable[[], None]) -> None:
+        """ Run install redirected into a staging prefix, save staged files as
+        artifact, then copy them into install_dir. """
+        with tempfile.TemporaryDirectory(prefix="exccpkg-stage-") as tmp_dir:
+            stage_dir = Path(tmp_dir)
+            with tools.redirect_install(stage_dir):
+                install()
+            self.save(key, stage_dir)
+            tools.sync_tree(stage_dir, self.install_dir)
+
+    def fetch(self, key: str, prefix: Path) -> bool:
+        """ Extract artifact into prefix, return False on miss. """
+        with tempfile.TemporaryDirectory(prefix="exccpkg-artifact-") as tmp_dir:
+            archive_path = Path(tmp_dir) / "artifact.tar.gz"
+            try:
+                found = self.store.get(key, archive_path)
+            except (OSError, requests.RequestException) as e:
+                logging.warning(f"Failed to fetch artifact={key} err={e}")
+                return False
+            if not found:
+                return False
+            logging.info(f"Restore artifact={key} -> {prefix}")
+            try:
+                with tarfile.open(archive_path, "r:gz") as tar:
+                    tar.extractall(prefix, filter="data")
+            except (tarfile.TarError, EOFError, zlib.error, gzip.BadGzipFile) as e:
+                logging.warning(f"Corrupt artifact={key} err={e}, build instead")
+                self.__clear(prefix)
+                return False
+        return True
+
+    @staticmethod
+    def __clear(prefix: Path) -> None:
+        """ Remove files partly extracted into prefix. """
+        for entry in prefix.iterdir():
+            if entry.is_dir() and not entry.is_symlink():
+                shutil.rmtree(entry)
+            else:
+                entry.unlink()
+
+    def save(self, key: str, prefix: Path) -> None:
+        """ Archive files installed into prefix as artifact. """
+        if not any(prefix.iterdir()):
+            logging.warning(f"Nothing installed into {prefix}, skip artifact={key}. "
+                            f"Does package install into tools.install_prefix?")
+            return
+        with tempfile.TemporaryDirectory(prefix="exccpkg-artifact-") as tmp_dir:
+            archive_path = Path(tmp_dir) / "artifact.tar.gz"
+            with tarfile.open(archive_path, "w:gz") as tar:
+                for entry in sorted(prefix.iterdir()):
+                    tar.add(entry, arcname=entry.name)
+            try:
+                self.store.put(key, archive_path)
+                logging.info(f"Saved artifact={key}")
+            except (OSError, requests.RequestException) as e:
+                logging.warning(f"Failed to save artifact={key} err={e}")
@@ -1,30 +1,106 @@
 # -*- coding: utf-8 -*-
 from abc import ABC, abstractmethod
 from collections import Counter, defaultdict
+from concurrent.futures import (
+    FIRST_COMPLETED, FIRST_EXCEPTION, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait)
+import contextlib
+import hashlib
+import heapq
 import importlib.util
 import inspect
+import itertools
+import json
 import logging
+import os
 from pathlib import Path
 import sys
-from typing import Any, Dict, List, Tuple
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 try:
     from typing import Self
 except ImportError:
     from typing_extensions import Self
 
+from exccpkg import cache, history, report, staging, tools, trace
+
 
 class Context:
     """ Add anything you need, then passed to resolve. """
+    # Downloader shared by all grab calls, pass it to tools.download. Assign a
+    # tools.Downloader to tune pool size, retries and timeouts.
+    downloader: Optional[tools.Downloader] = None
+    # Directory to keep states between resolves, like package fingerprints.
+    state_dir: Path = Path(".exccpkg")
+    # Restore installed files of packages built before instead of building.
+    artifact_cache: Optional[cache.ArtifactCache] = None
+    # Install packages into their own prefixes, then merge into install_dir.
+    installer: Optional[staging.StagedInstaller] = None
+    # Prefix packages are installed into. Incremental resolve rebuilds all
+    # packages if it is missing or empty.
+    install_dir: Optional[Path] = None
+    # Limit total jobs of commands run by tools.run_cmd, including jobs of
+    # make and ninja, across packages built at the same time.
+    jobserver: Optional[tools.JobServer] = None
+    # Attributes not affecting build results, excluded from fingerprint.
+    fingerprint_exclude: Tuple[str, ...] = (
+        "downloader", "state_dir", "artifact_cache", "installer", "jobserver", "install_dir")
+    # Environment variables affecting build results.
+    fingerprint_env: Tuple[str, ...] = ("CC", "CXX", "CFLAGS", "CXXFLAGS", "LDFLAGS")
+
     def __init__(self) -> None:
         ...
 
+    def fingerprint(self) -> str:
+        """ Digest of configuration affecting build results of all packages.
+
+        Covers attributes of plain values, paths and their containers,
+        recursively through objects, and environment variables listed in
+        fingerprint_env. Override to select relevant configurations.
+        """
+        digest = hashlib.sha256()
+        for name, value in sorted(vars(self).items()):
+            if name.startswith("_") or name in self.fingerprint_exclude:
+                continue
+            for key, item in _config_items(value, name):
+                digest.update(f"{key}={item}\n".encode())
+        for name in self.fingerprint_env:
+            digest.update(f"${name}={os.environ.get(name)}\n".encode())
+        return digest.hexdigest()
+
+
+def _config_items(obj: Any, prefix: str, depth: int = 0) -> Iterator[Tuple[str, str]]:
+    """ Flatten configuration object to key-value pairs. """
+    if isinstance(obj, (str, int, float, bool, Path)) or obj is None:
+        yield prefix, repr(obj)
+    elif depth >= 8:
+        return
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        items = sorted(obj, key=repr) if isinstance(obj, (set, frozenset)) else obj
+        for i, item in enumerate(items):
+            yield from _config_items(item, f"{prefix}[{i}]", depth + 1)
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=repr):
+            yield from _config_items(obj[key], f"{prefix}[{key!r}]", depth + 1)
+    elif hasattr(obj, "__dict__") and not callable(obj):
+        for name, value in sorted(vars(obj).items()):
+            if not name.startswith("_"):
+                yield from _config_items(value, f"{prefix}.{name}", depth + 1)
+
 
 class Package(ABC):
+    # Names of packages this package depends on. None means depending on all
+    # packages with larger depth.
+    depends: Optional[List[str]] = None
+    # Expected sha256 of downloaded source archive, pass it to tools.download.
+    sha256: Optional[str] = None
+
     def __init__(self) -> None:
         """
         Args:
             name: Package name, used to identify duplications.
             version: Package version, used to identify duplications.
+            depends: Optional package names, used to build dependency graph.
+            sha256: Optional source archive digest, used to verify downloads.
         """
         assert(hasattr(self, "name"))
         assert(hasattr(self, "version"))
@@ -44,11 +120,250 @@ class Package(ABC):
         """ Install package. Input context and build path. """
         ...
 
+    def fingerprint(self, ctx: Any, src_dir: Path) -> str:
+        """ Digest of inputs affecting build result, except dependencies.
+
+        Covers package id, source files, source code of package class, which
+        holds build options, and context configuration. Override to add more.
+        """
+        try:
+            class_src = inspect.getsource(self.__class__)
+        except (OSError, TypeError):
+            class_src = self.__class__.__qualname__
+        digest = hashlib.sha256()
+        for item in (getattr(self, "name"), getattr(self, "version"), tools.source_digest(src_dir),
+                     class_src, ctx.fingerprint() if hasattr(ctx, "fingerprint") else ""):
+            digest.update(f"{item}\n".encode())
+        return digest.hexdigest()
+
     def resolve(self, ctx: Any) -> None:
         """ Run grag, build and install in order. """
-        src_dir = self.grab(ctx)
-        build_dir = self.build(ctx, src_dir)
-        self.install(ctx, build_dir)
+        with trace.span("grab"):
+            src_dir = self.grab(ctx)
+        with trace.span("build"):
+            build_dir = self.build(ctx, src_dir)
+        with trace.span("install"):
+            self.install(ctx, build_dir)
+
+
+def _grab(
+    pkg: Package, ctx: Any, depth: int = 0, build_history: Optional[history.BuildHistory] = None
+) -> Path:
+    """ Grab package, traced and recorded into build_history. """
+    start = time.monotonic()
+    with trace.package(_pkg_id(pkg), depth), trace.span("grab"):
+        src_dir = pkg.grab(ctx)
+    if build_history is not None:
+        name, version = getattr(pkg, "name"), getattr(pkg, "version")
+        duration = time.monotonic() - start
+        # Walk sources not extracted by tools.unpack only once per version.
+        source_size = tools.source_size(Path(src_dir))
+        if source_size is None and build_history.source_size(name, version) is None:
+            source_size = tools.dir_size(Path(src_dir))
+        build_history.record_grab(name, version, duration, source_size)
+    return src_dir
+
+
+class _BuildReport:
+    """ Measurements of build and install of a package. """
+    def __init__(self, duration: float, peak_rss: int) -> None:
+        # Wall time in seconds.
+        self.duration = duration
+        # Peak memory of commands run, in bytes.
+        self.peak_rss = peak_rss
+        # "hit" or "miss" of artifact cache, None without it.
+        self.cache: Optional[str] = None
+        # Seconds of steps, like build and install.
+        self.steps: Dict[str, float] = dict()
+        # Trace events recorded in a process of the process backend.
+        self.events: List[Dict[str, Any]] = []
+
+
+def _build_and_install(
+    pkg: Package, ctx: Any, src_dir: Path, artifact_key: Optional[str] = None, depth: int = 0
+) -> _BuildReport:
+    """ Module level function so the process backend can pickle it. """
+    server: Optional[tools.JobServer] = getattr(ctx, "jobserver", None)
+    if server is not None and tools.jobserver() is not server:
+        # Running in a process of the process backend.
+        with tools.use_jobserver(server):
+            return _build_and_install(pkg, ctx, src_dir, artifact_key, depth)
+    if trace.current() is None:
+        # Running in a process of the process backend, hand spans back.
+        with trace.use(trace.Tracer()) as tracer:
+            build_report = _build_and_install(pkg, ctx, src_dir, artifact_key, depth)
+        build_report.events = tracer.events()
+        return build_report
+    # Output of concurrent builds goes to their own log files.
+    state_dir = Path(getattr(ctx, "state_dir", Context.state_dir))
+    log_path = state_dir / "logs" / f"{_pkg_id(pkg)}.log"
+    build_report = _BuildReport(0.0, 0)
+    start = time.monotonic()
+    with (tools.track_usage() as usage, tools.capture_output(log_path),
+          trace.package(_pkg_id(pkg), depth)):
+        _install_package(pkg, ctx, src_dir, artifact_key, build_report)
+    build_report.duration = time.monotonic() - start
+    build_report.peak_rss = usage.peak_rss
+    return build_report
+
+
+def _install_package(
+    pkg: Package, ctx: Any, src_dir: Path, artifact_key: Optional[str], build_report: _BuildReport
+) -> None:
+    def build() -> Path:
+        start = time.monotonic()
+        with trace.span("build"):
+            build_dir = pkg.build(ctx, src_dir)
+        build_report.steps["build"] = time.monotonic() - start
+        return build_dir
+
+    def install(build_dir: Path) -> None:
+        start = time.monotonic()
+        with trace.span("install"):
+            pkg.install(ctx, build_dir)
+        build_report.steps["install"] = time.monotonic() - start
+
+    artifact_cache: Optional[cache.ArtifactCache] = getattr(ctx, "artifact_cache", None)
+    if artifact_key is None:
+        artifact_cache = None
+    installer: Optional[staging.StagedInstaller] = getattr(ctx, "installer", None)
+    if installer is not None:
+        # Staged by name, so files dropped by a new version are removed.
+        name = getattr(pkg, "name")
+        prefix = installer.prepare(name)
+        restored = False
+        if artifact_cache is not None:
+            with trace.span("restore"):
+                restored = artifact_cache.fetch(artifact_key, prefix)
+            build_report.cache = "hit" if restored else "miss"
+        if not restored:
+            build_dir = build()
+            with tools.redirect_install(prefix):
+                install(build_dir)
+            if artifact_cache is not None:
+                artifact_cache.save(artifact_key, prefix)
+        with trace.span("merge"):
+            installer.commit(name)
+        return
+    if artifact_cache is None:
+        install(build())
+        return
+    with trace.span("restore"):
+        if artifact_cache.restore(artifact_key):
+            build_report.cache = "hit"
+            return
+    build_report.cache = "miss"
+    build_dir = build()
+    artifact_cache.install(artifact_key, lambda: install(build_dir))
+
+
+def _pkg_id(pkg: Package) -> str:
+    return f"{getattr(pkg, "name")}-{getattr(pkg, "version")}"
+
+
+class _FingerprintStore:
+    """ Fingerprints of installed packages, saved in ctx.state_dir.
+
+    A package fingerprint combines Package.fingerprint with fingerprints of
+    its dependencies, so dependents rebuild when a dependency changes.
+    """
+    def __init__(self, ctx: Context, graph: Dict[str, List[str]], incremental: bool) -> None:
+        self.__ctx = ctx
+        self.__graph = graph
+        self.__incremental = incremental
+        # Fingerprints also make artifact keys.
+        self.__enabled = incremental or getattr(ctx, "artifact_cache", None) is not None
+        self.__path = Path(getattr(ctx, "state_dir", Context.state_dir)) / "fingerprints.json"
+        self.__installed: Dict[str, str] = dict()
+        # Fingerprints of packages resolved in this run.
+        self.__resolved: Dict[str, str] = dict()
+        # Artifact keys, of fingerprints before build only, so build outputs
+        # written into src_dir of dependencies do not differ among machines.
+        self.__keys: Dict[str, str] = dict()
+        # Checked before anything is installed by this run.
+        self.__install_dir_exists = self.__check_install_dir()
+        if not incremental:
+            # Packages installed by this run are not what recorded.
+            self.__path.unlink(missing_ok=True)
+            return
+        try:
+            self.__installed = json.loads(self.__path.read_text())
+        except (OSError, ValueError):
+            pass
+
+    def up_to_date(self, pkg_id: str, pkg: Package, src_dir: Path) -> bool:
+        """ Check if package is installed with the same fingerprint. """
+        if not self.__enabled:
+            return False
+        own = pkg.fingerprint(self.__ctx, src_dir)
+        fingerprint = self.__fingerprint(pkg_id, own, self.__resolved)
+        self.__keys[pkg_id] = self.__fingerprint(pkg_id, own, self.__keys)
+        if not self.__incremental or self.__installed.get(pkg_id) != fingerprint:
+            return False
+        if not self.__install_exists(pkg):
+            logging.info(f"Rebuild pkg={pkg_id}, installed files are missing")
+            return False
+        logging.info(f"Skip unchanged pkg={pkg_id}")
+        self.__resolved[pkg_id] = fingerprint
+        return True
+
+    def artifact_key(self, pkg_id: str) -> Optional[str]:
+        """ Artifact cache key of package checked by up_to_date. """
+        if pkg_id not in self.__keys:
+            return None
+        return f"{pkg_id}-{self.__keys[pkg_id]}"
+
+    def record(self, pkg_id: str, pkg: Package, src_dir: Path) -> None:
+        """ Record fingerprint of an installed package. """
+        if not self.__enabled:
+            return
+        # Computed after install, so files written into src_dir by build
+        # match next run.
+        fingerprint = self.__fingerprint(pkg_id, pkg.fingerprint(self.__ctx, src_dir), self.__resolved)
+        self.__resolved[pkg_id] = fingerprint
+        if not self.__incremental:
+            return
+        self.__installed[pkg_id] = fingerprint
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.__path.with_name(self.__path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self.__installed, indent=1, sort_keys=True))
+        os.replace(tmp_path, self.__path)
+
+    def __install_exists(self, pkg: Package) -> bool:
+        """ Check if installed files of package are still there, as far as
+        known. All files in manifest of ctx.installer, otherwise a non-empty
+        ctx.install_dir or install_dir of ctx.artifact_cache. """
+        installer: Optional[staging.StagedInstaller] = getattr(self.__ctx, "installer", None)
+        if installer is not None:
+            manifest = installer.manifest(getattr(pkg, "name"))
+            if manifest is None:
+                return False
+            return all(os.path.lexists(installer.install_dir / rel_path)
+                       for rel_path in itertools.chain(manifest["files"], manifest["links"]))
+        return self.__install_dir_exists
+
+    def __check_install_dir(self) -> bool:
+        install_dir = getattr(self.__ctx, "install_dir", None)
+        artifact_cache = getattr(self.__ctx, "artifact_cache", None)
+        if install_dir is None and artifact_cache is not None:
+            install_dir = artifact_cache.install_dir
+        if install_dir is None:
+            return True
+        install_dir = Path(install_dir)
+        return install_dir.is_dir() and any(install_dir.iterdir())
+
+    def __fingerprint(self, pkg_id: str, own: str, deps: Dict[str, str]) -> str:
+        """ Combine own fingerprint of package with ones of dependencies. """
+        digest = hashlib.sha256(own.encode())
+        for dep in sorted(self.__graph[pkg_id]):
+            digest.update(f"\n{dep}={deps[dep]}".encode())
+        return digest.hexdigest()
+
+
+_EXECUTORS = {
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor,
+}
 
 
 class PackageCollection:
@@ -73,23 +388,296 @@ class PackageCollection:
         """ Add packages with larger depth. """
         self.__sub_collections.append(collection)
 
-    def resolve(self, ctx: Context) -> List[Package]:
-        # Resulve dependency map.
+    def resolve(
+        self, ctx: Context, jobs: int = 1, backend: str = "thread", grab_jobs: int = 1,
+        pipeline: bool = False, incremental: bool = False, mem_budget: Optional[int] = None
+    ) -> List[Package]:
+        """ Grab, build and install all packages, dependencies first.
+
+        Args:
+            jobs: Max number of packages to build and install at the same time.
+                A package starts once all packages it depends on are installed.
+            backend: "thread" or "process". The process backend requires
+                context and packages to be picklable, and changes made to the
+                context by build or install are not visible to the caller.
+            grab_jobs: Max number of packages to grab at the same time, grabs
+                always run in threads. Keep the downloader's pool size no less
+                than it to reuse connections.
+            pipeline: Build a package as soon as its own source is grabbed and
+                its dependencies are installed, while other grabs keep running.
+                Otherwise, building starts after all grabs are done.
+            incremental: Skip build and install of packages whose fingerprint,
+                see Package.fingerprint, matches the last successful install.
+                Dependents of a changed package are rebuilt.
+            mem_budget: Max total expected peak memory in bytes of packages
+                building at the same time. Peak memory of commands run by
+                tools.run_cmd is recorded for each package, see
+                history.BuildHistory. A package always starts if nothing else
+                is building.
+
+        Returns:
+            Packages in topological order.
+        """
+        if backend not in _EXECUTORS:
+            raise Exception(f"Unknown backend={backend}, expect one of {list(_EXECUTORS)}")
+        depth_pkgs, graph, order = self.__prepare()
+        id_pkgs: Dict[str, Package] = {self.__pkg_id(pkg): pkg for _, pkg in depth_pkgs}
+        depths: Dict[str, int] = {self.__pkg_id(pkg): depth for depth, pkg in depth_pkgs}
+        pkgs = [id_pkgs[pkg_id] for pkg_id in order]
+        state_dir = Path(getattr(ctx, "state_dir", Context.state_dir))
+        store = _FingerprintStore(ctx, graph, incremental)
+        # Grab, build and install.
+        with (contextlib.closing(history.BuildHistory(state_dir)) as build_history,
+              trace.record(state_dir / "trace.json"), trace.span("resolve"),
+              tools.use_jobserver(getattr(ctx, "jobserver", None))):
+            if pipeline:
+                with (ThreadPoolExecutor(max_workers=max(grab_jobs, 1)) as grab_executor,
+                      _EXECUTORS[backend](max_workers=max(jobs, 1)) as executor):
+                    grabs = {pkg_id: grab_executor.submit(
+                                _grab, id_pkgs[pkg_id], ctx, depths[pkg_id], build_history)
+                             for pkg_id in order}
+                    self.__run_graph(executor, ctx, id_pkgs, depths, graph, order, grabs, store,
+                                     build_history, jobs, mem_budget)
+                return pkgs
+            src_dirs = self.__grab_all(ctx, id_pkgs, depths, order, grab_jobs, build_history)
+            if jobs <= 1:
+                for pkg_id in order:
+                    pkg, src_dir = id_pkgs[pkg_id], src_dirs[pkg_id]
+                    if not store.up_to_date(pkg_id, pkg, src_dir):
+                        build_report = _build_and_install(
+                            pkg, ctx, src_dir, store.artifact_key(pkg_id), depths[pkg_id])
+                        self.__record(build_history, pkg, build_report)
+                        store.record(pkg_id, pkg, src_dir)
+                return pkgs
+            grabs: Dict[str, Future] = dict()
+            for pkg_id, src_dir in src_dirs.items():
+                grabs[pkg_id] = Future()
+                grabs[pkg_id].set_result(src_dir)
+            with _EXECUTORS[backend](max_workers=jobs) as executor:
+                self.__run_graph(executor, ctx, id_pkgs, depths, graph, order, grabs, store,
+                                 build_history, jobs, mem_budget)
+            return pkgs
+
+    def report(self, ctx: Context, jobs: Sequence[int] = (1, 2, 4, 8, 16)) -> report.GraphReport:
+        """ Critical path, speedup by jobs and cache candidates, estimated by
+        durations of the last builds recorded in ctx.state_dir. Print it. """
+        depth_pkgs, graph, order = self.__prepare()
+        state_dir = Path(getattr(ctx, "state_dir", Context.state_dir))
+        with contextlib.closing(history.BuildHistory(state_dir)) as build_history:
+            durations = {self.__pkg_id(pkg): build_history.duration(getattr(pkg, "name"))
+                         for _, pkg in depth_pkgs}
+        return report.GraphReport(
+            graph, order, {self.__pkg_id(pkg): depth for depth, pkg in depth_pkgs}, durations, jobs)
+
+    @staticmethod
+    def __record(build_history: history.BuildHistory, pkg: Package, build_report: _BuildReport) -> None:
+        build_history.record(getattr(pkg, "name"), getattr(pkg, "version"), build_report.duration,
+                             build_report.peak_rss, build_report.cache, build_report.steps)
+
+    def __prepare(self) -> Tuple[List[Tuple[int, Package]], Dict[str, List[str]], List[str]]:
+        """ Resolve dependency map, return packages with depth, dependency
+        graph and topological order. """
         self.__check_conflictions()
         self.__set_depth(self.__depth)
         depth_pkgs: List[Tuple[int, Package]] = self.__filter_pkgs()
         logging.debug(f"Resolved pkgs={[(pkg[0], self.__pkg_id(pkg[1])) for pkg in depth_pkgs]}")
-        pkgs = [pkg[1] for pkg in depth_pkgs]
-        # Grab, build and install.
-        src_dirs = [pkg.grab(ctx) for pkg in pkgs]
-        for pkg, src_dir in zip(pkgs, src_dirs):
-            build_dir = pkg.build(ctx, src_dir)
-            pkg.install(ctx, build_dir)
-        return pkgs
+        graph = self.__build_graph(depth_pkgs)
+        order = self.__toposort(graph)
+        logging.debug(f"Resolve order={order}")
+        return depth_pkgs, graph, order
+
+    @classmethod
+    def __build_graph(cls, depth_pkgs: List[Tuple[int, Package]]) -> Dict[str, List[str]]:
+        """ Map package id to ids of packages it depends on, in depth order. """
+        name_ids: Dict[str, str] = {getattr(pkg, "name"): cls.__pkg_id(pkg) for _, pkg in depth_pkgs}
+        graph: Dict[str, List[str]] = dict()
+        for depth, pkg in depth_pkgs:
+            pkg_id = cls.__pkg_id(pkg)
+            if pkg.depends is None:
+                graph[pkg_id] = [cls.__pkg_id(dep) for dep_depth, dep in depth_pkgs if dep_depth > depth]
+                continue
+            missing = [name for name in pkg.depends if name not in name_ids]
+            if missing:
+                logging.error(f"Package {pkg_id} depends on unknown packages={missing}")
+                raise Exception(f"Unknown dependency")
+            graph[pkg_id] = [name_ids[name] for name in pkg.depends]
+        return graph
+
+    @staticmethod
+    def __toposort(graph: Dict[str, List[str]]) -> List[str]:
+        """ Kahn's algorithm, ties are broken by the order of graph keys. """
+        index = {pkg_id: i for i, pkg_id in enumerate(graph)}
+        remaining = {pkg_id: len(deps) for pkg_id, deps in graph.items()}
+        dependents: Dict[str, List[str]] = defaultdict(list)
+        for pkg_id, deps in graph.items():
+            for dep in deps:
+                dependents[dep].append(pkg_id)
+        ready = [index[pkg_id] for pkg_id, count in remaining.items() if count == 0]
+        heapq.heapify(ready)
+        keys = list(graph)
+        order: List[str] = []
+        while ready:
+            pkg_id = keys[heapq.heappop(ready)]
+            order.append(pkg_id)
+            for dependent in dependents[pkg_id]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    heapq.heappush(ready, index[dependent])
+        if len(order) != len(graph):
+            cycle = [pkg_id for pkg_id, count in remaining.items() if count > 0]
+            logging.error(f"Dependency cycle among pkgs={cycle}")
+            raise Exception(f"Dependency cycle")
+        return order
+
+    @staticmethod
+    def __grab_all(
+        ctx: Context, id_pkgs: Dict[str, Package], depths: Dict[str, int], order: List[str],
+        grab_jobs: int, build_history: history.BuildHistory
+    ) -> Dict[str, Path]:
+        """ Grab packages in parallel, report all failures at the end. """
+        if grab_jobs <= 1:
+            return {pkg_id: _grab(id_pkgs[pkg_id], ctx, depths[pkg_id], build_history)
+                    for pkg_id in order}
+        with ThreadPoolExecutor(max_workers=grab_jobs) as executor:
+            futures: Dict[str, Future] = {
+                pkg_id: executor.submit(_grab, id_pkgs[pkg_id], ctx, depths[pkg_id], build_history)
+                for pkg_id in order
+            }
+            done, pending = wait(futures.values(), return_when=FIRST_EXCEPTION)
+            if pending:
+                # Stop packages that are not started, wait for running ones.
+                for future in pending:
+                    future.cancel()
+                wait(pending)
+        failed: List[str] = []
+        for pkg_id, future in futures.items():
+            if not future.cancelled() and future.exception() is not None:
+                logging.error(f"Failed to grab pkg={pkg_id}", exc_info=future.exception())
+                failed.append(pkg_id)
+        if failed:
+            logging.error(f"Failed pkgs={failed}")
+            raise Exception(f"Failed to grab pkgs={failed}")
+        return {pkg_id: future.result() for pkg_id, future in futures.items()}
+
+    @classmethod
+    def __run_graph(
+        cls, executor: Executor, ctx: Context, id_pkgs: Dict[str, Package],
+        depths: Dict[str, int], graph: Dict[str, List[str]], order: List[str], grabs: Dict[str, Future],
+        store: _FingerprintStore, build_history: history.BuildHistory, jobs: int,
+        mem_budget: Optional[int]
+    ) -> None:
+        """ Build and install each package as soon as its source is grabbed and
+        its dependencies are installed, and its expected peak memory fits
+        mem_budget. """
+        remaining = {pkg_id: len(deps) for pkg_id, deps in graph.items()}
+        dependents: Dict[str, List[str]] = defaultdict(list)
+        for pkg_id in order:
+            for dep in graph[pkg_id]:
+                dependents[dep].append(pkg_id)
+        grabbing: Dict[Future, str] = {grabs[pkg_id]: pkg_id for pkg_id in order}
+        building: Dict[Future, str] = dict()
+        # Packages ready to build, and expected peak memory of building ones.
+        # Packages heading the longest expected chains of builds start first,
+        # ties broken by order.
+        durations = {pkg_id: build_history.duration(getattr(id_pkgs[pkg_id], "name"))
+                     for pkg_id in order}
+        priority = report.GraphReport(graph, order, depths, durations, jobs=()).priority
+        ready: List[str] = []
+        reserved: Dict[str, int] = dict()
+        src_dirs: Dict[str, Path] = dict()
+        installed: List[str] = []
+        failed: List[str] = []
+
+        def on_grabbed(future: Future) -> None:
+            pkg_id = grabbing.pop(future)
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                logging.error(f"Failed to grab pkg={pkg_id}", exc_info=future.exception())
+                failed.append(pkg_id)
+                return
+            src_dirs[pkg_id] = future.result()
+            try_build(pkg_id)
+
+        def on_installed(future: Future) -> None:
+            pkg_id = building.pop(future)
+            reserved.pop(pkg_id, None)
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                logging.error(f"Failed to resolve pkg={pkg_id}", exc_info=future.exception())
+                failed.append(pkg_id)
+                return
+            build_report: _BuildReport = future.result()
+            if build_report.events:
+                # Spans recorded by the process backend.
+                trace.current().extend(build_report.events)
+            cls.__record(build_history, id_pkgs[pkg_id], build_report)
+            store.record(pkg_id, id_pkgs[pkg_id], src_dirs[pkg_id])
+            on_resolved(pkg_id)
+
+        def on_resolved(pkg_id: str) -> None:
+            installed.append(pkg_id)
+            for dependent in dependents[pkg_id]:
+                remaining[dependent] -= 1
+                try_build(dependent)
+
+        def try_build(pkg_id: str) -> None:
+            if failed or remaining[pkg_id] > 0 or pkg_id not in src_dirs:
+                return
+            if store.up_to_date(pkg_id, id_pkgs[pkg_id], src_dirs[pkg_id]):
+                on_resolved(pkg_id)
+                return
+            ready.append(pkg_id)
+
+        def submit_ready() -> None:
+            ready.sort(key=priority.__getitem__)
+            for pkg_id in list(ready):
+                # Keep the rest in ready instead of the executor queue, so
+                # priority applies again whenever a job finishes. Building
+                # packages are running ones, as is reserved memory.
+                if len(building) >= max(jobs, 1):
+                    break
+                if mem_budget is not None:
+                    # First fit by priority.
+                    expected = build_history.expected_peak_rss(getattr(id_pkgs[pkg_id], "name"))
+                    if building and sum(reserved.values()) + expected > mem_budget:
+                        continue
+                    reserved[pkg_id] = expected
+                ready.remove(pkg_id)
+                future = executor.submit(
+                    _build_and_install, id_pkgs[pkg_id], ctx, src_dirs[pkg_id],
+                    store.artifact_key(pkg_id), depths[pkg_id])
+                building[future] = pkg_id
+
+        # Consume finished grabs in order to keep submission order stable.
+        for pkg_id in order:
+            if grabs[pkg_id].done():
+                on_grabbed(grabs[pkg_id])
+        submit_ready()
+        while grabbing or building:
+            done, _ = wait(list(grabbing) + list(building), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in grabbing:
+                    on_grabbed(future)
+                else:
+                    on_installed(future)
+            if not failed:
+                submit_ready()
+            else:
+                # Stop packages that are not started, wait for running ones.
+                for future in itertools.chain(grabbing, building):
+                    future.cancel()
+        if failed:
+            skipped = [pkg_id for pkg_id in order if pkg_id not in installed and pkg_id not in failed]
+            logging.error(f"Failed pkgs={failed}")
+            if skipped:
+                logging.error(f"Skipped pkgs={skipped}")
+            raise Exception(f"Failed to resolve pkgs={failed}")
 
     @staticmethod
     def __pkg_id(pkg: Package) -> str:
-        return f"{getattr(pkg, "name")}-{getattr(pkg, "version")}"
+        return _pkg_id(pkg)
 
     def __set_depth(self, depth: int) -> None:
         self.__depth = depth
@@ -115,31 +703,44 @@ class PackageCollection:
         return pkgs_sorted
 
     def __check_conflictions(self) -> None:
-        """ Check if there are packages with same name but different versions. """
-        # Get all packages.
-        pkgs: List[Package] = self.__pkgs
-        for collection in self.__sub_collections:
-            pkgs.extend(collection.__pkgs)
-        names = [getattr(pkg, "name") for pkg in pkgs]
-        vers = [getattr(pkg, "version") for pkg in pkgs]
-        infos = [
-            f"{inspect.getsourcefile(pkg.__class__)}:{inspect.getsourcelines(pkg.__class__)[1]}"
-            for pkg in pkgs
-        ]
-        # Check version conflictions.
-        # Dict[name, Dict[vers, info]]
-        dup_deps: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
-        for i in range(len(pkgs)):
-            dup_deps[names[i]].append((vers[i], infos[i]))
-        for name, dups in dup_deps.items():
-            ver_count = len(set([dup[0] for dup in dups]))
-            if ver_count > 1:
-                logging.error("Version confliction:")
-                logging.error(f"Package name: {name}")
-                logging.error(f"Package versions: {dups}")
-                raise Exception(f'Version confliction')
-            elif ver_count == 1 and len(dups) > 1:
-                logging.debug(f"Found duplicates name={name} vers={dups}")
+        """ Check if there are packages with same name but different versions
+        in all levels of sub collections. """
+        # Dict[name, Dict[version, List[Package]]]
+        name_vers: Dict[str, Dict[str, List[Package]]] = defaultdict(lambda: defaultdict(list))
+        for pkg in self.__walk_pkgs():
+            name_vers[getattr(pkg, "name")][getattr(pkg, "version")].append(pkg)
+        conflicts: List[str] = []
+        for name, vers in name_vers.items():
+            if len(vers) > 1:
+                conflicts.append(name)
+            elif len(next(iter(vers.values()))) > 1:
+                logging.debug(f"Found duplicates name={name} vers={list(vers)}")
+        if not conflicts:
+            return
+        # Locating package classes reads their source, only do it for errors.
+        logging.error("Version confliction:")
+        for name in conflicts:
+            logging.error(f"Package name: {name}")
+            dups = [(ver, info) for ver, pkgs in name_vers[name].items()
+                    for info in dict.fromkeys(self.__source_location(pkg) for pkg in pkgs)]
+            logging.error(f"Package versions: {dups}")
+        raise Exception(f"Version confliction of pkgs={conflicts}")
+
+    def __walk_pkgs(self) -> Iterator[Package]:
+        """ Packages of this and all levels of sub collections, duplicates
+        included. """
+        collections: List[PackageCollection] = [self]
+        while collections:
+            collection = collections.pop()
+            yield from collection.__pkgs
+            collections.extend(reversed(collection.__sub_collections))
+
+    @staticmethod
+    def __source_location(pkg: Package) -> str:
+        try:
+            return f"{inspect.getsourcefile(pkg.__class__)}:{inspect.getsourcelines(pkg.__class__)[1]}"
+        except (OSError, TypeError):
+            return pkg.__class__.__qualname__
 
     @staticmethod
     def __import_from_path(module_name, file_path):
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class BuildHistory:
+    """ Measurements of previous runs, in sqlite database
+    state_dir/history.sqlite3.
+
+    Each grab, build, install, and build and install of a package as a whole,
+    called package step, is a row. Queries are by package name, so history
+    carries over version bumps. Only the last keep rows of each step of a
+    package are kept, older ones are pruned on close.
+    """
+    # Expected peak memory of packages never measured, in bytes.
+    default_peak_rss = 2 * 1024 ** 3
+
+    def __init__(self, state_dir: Path, keep: int = 20) -> None:
+        state_dir.mkdir(parents=True, exist_ok=True)
+        self.keep = keep
+        self.__lock = threading.Lock()
+        # Grabs are recorded from grab threads.
+        self.__db = sqlite3.connect(state_dir / "history.sqlite3", check_same_thread=False)
+        # Losing the last rows on power failure is fine, fsync of each commit
+        # is not.
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        with self.__db:
+            self.__db.execute("""
+                CREATE TABLE IF NOT EXISTS steps (
+                    name TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    step TEXT NOT NULL,
+                    time REAL NOT NULL,
+                    duration REAL NOT NULL,
+                    peak_rss INTEGER,
+                    cache TEXT,
+                    source_size INTEGER
+                )""")
+            self.__db.execute(
+                "CREATE INDEX IF NOT EXISTS steps_name ON steps (name, step, time)")
+
+    def close(self) -> None:
+        """ Prune old rows and close database. """
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("""
+                    DELETE FROM steps WHERE rowid IN (
+                        SELECT rowid FROM (
+                            SELECT rowid, ROW_NUMBER() OVER (
+                                PARTITION BY name, step ORDER BY time DESC) AS n
+                            FROM steps)
+                        WHERE n > ?)""", (self.keep,))
+            self.__db.close()
+
+    def record_grab(
+        self, name: str, version: str, duration: float, source_size: Optional[int] = None
+    ) -> None:
+        """ Record a finished grab, source_size is total bytes of source files,
+        None if not measured. """
+        self.__insert([(name, version, "grab", duration, None, None, source_size)])
+
+    def record(
+        self, name: str, version: str, duration: float, peak_rss: int,
+        cache: Optional[str] = None, steps: Optional[Dict[str, float]] = None
+    ) -> None:
+        """ Record a finished build and install.
+
+        Args:
+            duration: Seconds of build and install as a whole.
+            peak_rss: Peak memory of commands run, in bytes.
+            cache: "hit" if restored from artifact cache, "miss" if built and
+                saved, None without artifact cache.
+            steps: Seconds of each step, like build and install.
+        """
+        rows = [(name, version, step, step_duration, None, None, None)
+                for step, step_duration in (steps or dict()).items()]
+        rows.append((name, version, "package", duration, peak_rss, cache, None))
+        self.__insert(rows)
+
+    def duration(self, name: str) -> Optional[float]:
+        """ Seconds of the last build and install, None if unknown. Builds
+        restored from cache are ignored unless there is no other. """
+        row = self.__query("""
+            SELECT duration FROM steps WHERE name = ? AND step = 'package'
+            ORDER BY cache IS 'hit', time DESC LIMIT 1""", (name,))
+        return row[0] if row is not None else None
+
+    def source_size(self, name: str, version: str) -> Optional[int]:
+        """ Last recorded bytes of source files of version, None if unknown. """
+        row = self.__query("""
+            SELECT source_size FROM steps
+            WHERE name = ? AND version = ? AND step = 'grab' AND source_size IS NOT NULL
+            ORDER BY time DESC LIMIT 1""", (name, version))
+        return row[0] if row is not None else None
+
+    def grab_duration(self, name: str) -> Optional[float]:
+        """ Seconds of the last grab, None if unknown. """
+        row = self.__query("""
+            SELECT duration FROM steps WHERE name = ? AND step = 'grab'
+            ORDER BY time DESC LIMIT 1""", (name,))
+        return row[0] if row is not None else None
+
+    def peak_rss(self, name: str) -> Optional[int]:
+        """ Peak memory of commands run by the last build, None if unknown.
+        Builds restored from cache run nothing and are ignored.
+
+        It is the largest CmdResult.peak_rss of the build. On Linux that is
+        the peak total of the command tree, elsewhere ru_maxrss of the
+        largest single process, which underestimates parallel builds like
+        make -j by up to the number of jobs.
+        """
+        row = self.__query("""
+            SELECT peak_rss FROM steps WHERE name = ? AND step = 'package' AND cache IS NOT 'hit'
+            ORDER BY time DESC LIMIT 1""", (name,))
+        return row[0] if row is not None else None
+
+    def expected_peak_rss(self, name: str) -> int:
+        """ Peak memory expected for next build. Unknown packages are assumed
+        to be as heavy as the heaviest one known, at least default_peak_rss. """
+        peak_rss = self.peak_rss(name)
+        if peak_rss is not None:
+            return peak_rss
+        row = self.__query("SELECT MAX(peak_rss) FROM steps WHERE step = 'package'", ())
+        return max(row[0] or 0, self.default_peak_rss)
+
+    def __insert(self, rows: List[Tuple]) -> None:
+        """ Insert rows of (name, version, step, duration, peak_rss, cache,
+        source_size) in one transaction. """
+        now = time.time()
+        with self.__lock, self.__db:
+            self.__db.executemany(
+                "INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(name, version, step, now, *values) for name, version, step, *values in rows])
+
+    def __query(self, sql: str, params: tuple) -> Optional[tuple]:
+        with self.__lock:
+            return self.__db.execute(sql, params).fetchone()
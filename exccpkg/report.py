@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import heapq
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+class GraphReport:
+    """ Critical path and parallelism of a package graph, estimated from
+    durations of previous builds.
+
+    Makespans are simulated by scheduling ready packages by priority, the
+    same way as PackageCollection.resolve, longest expected chain of builds
+    first, ignoring grabs.
+    """
+    def __init__(
+        self, graph: Dict[str, List[str]], order: List[str], depths: Dict[str, int],
+        durations: Dict[str, Optional[float]], jobs: Sequence[int] = (1, 2, 4, 8, 16)
+    ) -> None:
+        """
+        Args:
+            graph: Package id to ids of packages it depends on.
+            order: Package ids in topological order, breaking ties of priority.
+            depths: Package id to depth of collection.
+            durations: Package id to seconds taken by its last build and
+                install, None if never built. Unknown ones are assumed to take
+                the mean of known ones.
+            jobs: Numbers of jobs to estimate speedup for.
+        """
+        self.graph = graph
+        self.order = order
+        self.depths = depths
+        self.unknown = [pkg_id for pkg_id in order if durations.get(pkg_id) is None]
+        known = [durations[pkg_id] for pkg_id in order if pkg_id not in self.unknown]
+        self.default_duration = sum(known) / len(known) if known else 0.0
+        self.durations: Dict[str, float] = {
+            pkg_id: durations[pkg_id] if pkg_id not in self.unknown else self.default_duration
+            for pkg_id in order
+        }
+        self.total = sum(self.durations.values())
+        self.dependents: Dict[str, List[str]] = {pkg_id: [] for pkg_id in order}
+        for pkg_id in order:
+            for dep in graph[pkg_id]:
+                self.dependents[dep].append(pkg_id)
+        # Bottom level, seconds from start of a package to end of the longest
+        # chain of its dependents. Sort key of ready packages, so a short
+        # package gating a long one starts before other short ones.
+        self.levels: Dict[str, float] = dict()
+        for pkg_id in reversed(order):
+            self.levels[pkg_id] = self.durations[pkg_id] + max(
+                (self.levels[dependent] for dependent in self.dependents[pkg_id]), default=0.0)
+        self.priority: Dict[str, Tuple[float, int]] = {
+            pkg_id: (-self.levels[pkg_id], i) for i, pkg_id in enumerate(order)
+        }
+        self.critical_path = self.__critical_path(self.durations)
+        self.critical_length = sum(self.durations[pkg_id] for pkg_id in self.critical_path)
+        self.makespans: Dict[int, float] = {n: self.makespan(n) for n in jobs}
+
+    def makespan(self, jobs: int) -> float:
+        """ Simulated seconds to build all packages with jobs workers. """
+        return max((finish for _, _, finish in self.schedule(jobs)), default=0.0)
+
+    def schedule(self, jobs: int) -> List[Tuple[str, float, float]]:
+        """ Simulated start and finish seconds of packages with jobs workers,
+        as (package id, start, finish) in start order. """
+        remaining = {pkg_id: len(deps) for pkg_id, deps in self.graph.items()}
+        ready = [(self.priority[pkg_id], pkg_id) for pkg_id in self.order if remaining[pkg_id] == 0]
+        heapq.heapify(ready)
+        # Finish time and id of running packages.
+        running: List[Tuple[float, str]] = []
+        started: List[Tuple[str, float, float]] = []
+        now = 0.0
+        while ready or running:
+            while ready and len(running) < jobs:
+                _, pkg_id = heapq.heappop(ready)
+                started.append((pkg_id, now, now + self.durations[pkg_id]))
+                heapq.heappush(running, (now + self.durations[pkg_id], pkg_id))
+            now, pkg_id = heapq.heappop(running)
+            for dependent in self.dependents[pkg_id]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    heapq.heappush(ready, (self.priority[dependent], dependent))
+        return started
+
+    def plan(self, jobs: int) -> str:
+        """ Text of simulated schedule with jobs workers, for dry runs. """
+        started = self.schedule(jobs)
+        makespan = max((finish for _, _, finish in started), default=0.0)
+        lines = [f"Estimated {makespan:.1f}s to build {len(started)} packages "
+                 f"with jobs={jobs}, excluding grabs:"]
+        for pkg_id, start, finish in started:
+            unknown = " (never built)" if pkg_id in self.unknown else ""
+            lines.append(f"  {start:10.1f}s - {finish:10.1f}s  {pkg_id}{unknown}")
+        return "\n".join(lines)
+
+    def cache_candidates(self, top: int = 5) -> List[Tuple[str, float, float]]:
+        """ Packages saving the most time if restored from cache instead of
+        built, as (package id, own duration, critical path reduction). """
+        candidates = []
+        for pkg_id in self.order:
+            durations = dict(self.durations)
+            durations[pkg_id] = 0.0
+            length = sum(durations[dep] for dep in self.__critical_path(durations))
+            candidates.append((pkg_id, self.durations[pkg_id], self.critical_length - length))
+        candidates.sort(key=lambda item: (item[2], item[1]), reverse=True)
+        return candidates[:top]
+
+    def __critical_path(self, durations: Dict[str, float]) -> List[str]:
+        """ Longest chain of dependencies by total duration. """
+        finish: Dict[str, float] = dict()
+        prev: Dict[str, Optional[str]] = dict()
+        for pkg_id in self.order:
+            dep = max(self.graph[pkg_id], key=lambda dep: finish[dep], default=None)
+            finish[pkg_id] = (finish[dep] if dep is not None else 0.0) + durations[pkg_id]
+            prev[pkg_id] = dep
+        path: List[str] = []
+        pkg_id = max(self.order, key=lambda pkg_id: finish[pkg_id], default=None)
+        while pkg_id is not None:
+            path.append(pkg_id)
+            pkg_id = prev[pkg_id]
+        return path[::-1]
+
+    def __str__(self) -> str:
+        if self.total == 0:
+            return f"No build durations recorded for {len(self.order)} packages, resolve first."
+        lines = [f"Critical path: {self.critical_length:.1f}s of {self.total:.1f}s total, "
+                 f"{len(self.critical_path)} of {len(self.order)} packages"]
+        for pkg_id in self.critical_path:
+            lines.append(f"  {self.durations[pkg_id]:10.1f}s  {pkg_id} (depth {self.depths[pkg_id]})")
+        lines.append("Speedup by jobs:")
+        lines.append(f"  {'jobs':>6} {'time':>10} {'speedup':>8} {'efficiency':>10}")
+        for jobs, makespan in self.makespans.items():
+            speedup = self.total / makespan if makespan > 0 else 1.0
+            lines.append(f"  {jobs:>6} {makespan:>9.1f}s {speedup:>7.2f}x {speedup / jobs:>10.0%}")
+        if self.critical_length > 0:
+            lines.append(f"  Bound by critical path: {self.total / self.critical_length:.2f}x")
+        lines.append("Cache candidates, time saved on critical path and in total:")
+        for pkg_id, duration, saved in self.cache_candidates():
+            lines.append(f"  {saved:10.1f}s {duration:10.1f}s  {pkg_id}")
+        if self.unknown:
+            lines.append(f"Never built, assumed {self.default_duration:.1f}s: {', '.join(self.unknown)}")
+        return "\n".join(lines)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+from typing import Dict, List, Optional
+
+from exccpkg import tools
+
+
+class StagedInstaller:
+    """ Install packages into their own staging prefixes, then merge into
+    install_dir by hardlinks.
+
+    A manifest of files and hashes is recorded for each package, so files of
+    one package can be removed or relinked without touching others, and
+    files dropped by a new version are removed from install_dir.
+    """
+    def __init__(self, install_dir: Path, stage_dir: Optional[Path] = None) -> None:
+        """
+        Args:
+            install_dir: Shared prefix that packages are merged into.
+            stage_dir: Where staging prefixes and manifests are kept, default
+                to .<install_dir name>.stage next to install_dir.
+        """
+        self.install_dir = install_dir
+        if stage_dir is None:
+            stage_dir = install_dir.parent / f".{install_dir.name}.stage"
+        self.stage_dir = stage_dir
+
+    def prefix(self, pkg_name: str) -> Path:
+        """ Staging prefix of package. """
+        return self.stage_dir / "pkgs" / pkg_name
+
+    def prepare(self, pkg_name: str) -> Path:
+        """ Create an empty staging prefix for package to install into. """
+        prefix = self.prefix(pkg_name)
+        if prefix.exists():
+            shutil.rmtree(prefix)
+        prefix.mkdir(parents=True)
+        return prefix
+
+    def commit(self, pkg_name: str) -> None:
+        """ Record manifest of staged files and merge them into install_dir. """
+        old_manifest = self.manifest(pkg_name)
+        prefix = self.prefix(pkg_name)
+        files: Dict[str, str] = dict()
+        links: Dict[str, str] = dict()
+        for root, dirs, names in os.walk(prefix):
+            # Symlinks to directories are listed in dirs.
+            for name in dirs + names:
+                path = Path(root, name)
+                rel_path = path.relative_to(prefix).as_posix()
+                if path.is_symlink():
+                    links[rel_path] = os.readlink(path)
+                elif path.is_file():
+                    files[rel_path] = tools.file_sha256(path)
+        manifest = {"files": files, "links": links}
+        manifest_path = self.__manifest_path(pkg_name)
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+        os.replace(tmp_path, manifest_path)
+        if old_manifest is not None:
+            stale = {rel_path: digest for rel_path, digest in old_manifest["files"].items()
+                     if rel_path not in files}
+            self.__remove_files(stale, [rel_path for rel_path in old_manifest["links"]
+                                        if rel_path not in links])
+        self.relink(pkg_name)
+
+    def relink(self, pkg_name: str) -> None:
+        """ Merge staged files of package into install_dir. """
+        manifest = self.manifest(pkg_name)
+        if manifest is None:
+            raise Exception(f"No manifest of pkg={pkg_name}")
+        prefix = self.prefix(pkg_name)
+        logging.info(f"Merge {prefix} -> {self.install_dir}")
+        # Keep files of the same content, their mtimes stay unchanged so
+        # dependent projects are not rebuilt.
+        replaced = 0
+        for rel_path, digest in manifest["files"].items():
+            replaced += tools.sync_file(prefix / rel_path, self.install_dir / rel_path,
+                                        link=True, digest=digest)
+        for rel_path, target in manifest["links"].items():
+            replaced += tools.sync_symlink(target, self.install_dir / rel_path)
+        logging.info(f"Merged pkg={pkg_name}, replaced {replaced} of "
+                     f"{len(manifest['files']) + len(manifest['links'])} files")
+
+    def remove(self, pkg_name: str) -> None:
+        """ Remove files of package from install_dir, with its staging prefix. """
+        manifest = self.manifest(pkg_name)
+        if manifest is None:
+            return
+        logging.info(f"Remove pkg={pkg_name} from {self.install_dir}")
+        self.__remove_files(manifest["files"], list(manifest["links"]))
+        shutil.rmtree(self.prefix(pkg_name), ignore_errors=True)
+        self.__manifest_path(pkg_name).unlink()
+
+    def manifest(self, pkg_name: str) -> Optional[Dict[str, Dict[str, str]]]:
+        """ Manifest of installed package, None if not installed. """
+        try:
+            return json.loads(self.__manifest_path(pkg_name).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def installed(self) -> List[str]:
+        """ Names of installed packages. """
+        return sorted(path.stem for path in (self.stage_dir / "manifests").glob("*.json"))
+
+    def __manifest_path(self, pkg_name: str) -> Path:
+        return self.stage_dir / "manifests" / f"{pkg_name}.json"
+
+    def __remove_files(self, files: Dict[str, str], links: List[str]) -> None:
+        """ Remove files still matching recorded hashes, then empty directories. """
+        dirs = set()
+        for rel_path, digest in files.items():
+            dst = self.install_dir / rel_path
+            # Leave files overwritten by other packages.
+            if dst.is_file() and not dst.is_symlink() and tools.file_sha256(dst) == digest:
+                logging.debug(f"Remove {dst}")
+                dst.unlink()
+                dirs.add(dst.parent)
+        for rel_path in links:
+            dst = self.install_dir / rel_path
+            if dst.is_symlink():
+                dst.unlink()
+                dirs.add(dst.parent)
+        for dir in sorted(dirs, key=lambda d: len(d.parts), reverse=True):
+            while dir != self.install_dir and dir.is_dir() and not any(dir.iterdir()):
+                dir.rmdir()
+                dir = dir.parent
@@ -1,18 +1,50 @@
 # -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import contextlib
+import contextvars
 import errno
+import filecmp
+import hashlib
+import json
 import logging
 import os
 from pathlib import Path
 import platform
 import requests
+from requests.adapters import HTTPAdapter
+import shlex
 import shutil
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from typing import (
+    TYPE_CHECKING, Any, BinaryIO, Callable, Dict, Iterator, List, Mapping, Optional, Sequence,
+    Tuple, Union)
+from urllib3.util.retry import Retry
+
+from exccpkg import trace
+if TYPE_CHECKING:
+    from exccpkg.cache import DownloadCache
 try:
     from tqdm import tqdm
 except ImportError:
-    def __dummy_tqdm(iterable, total=None):
-        return iterable
-    tqdm = __dummy_tqdm
+    class tqdm:
+        """ Dummy progress bar. """
+        def __init__(self, *args, **kwargs) -> None:
+            ...
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args) -> None:
+            ...
+
+        def update(self, n: int = 1) -> None:
+            ...
 
 
 def mkdirp(dir: Path, dryrun: bool=False) -> None:
@@ -23,27 +55,910 @@ def mkdirp(dir: Path, dryrun: bool=False) -> None:
     dir.mkdir(parents=True, exist_ok=True)
 
 
-def download(url: str, file_path: Path, dryrun: bool=False) -> None:
-    """ Download file from the url to file_path. """
-    logging.info(f"Download: {url} -> {file_path}")
-    if dryrun:
+def file_sha256(file_path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """ Hex sha256 digest of file content. """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as fs:
+        while data := fs.read(chunk_size):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def __sha256_record_path(file_path: Path) -> Path:
+    return file_path.with_name(file_path.name + ".sha256")
+
+
+def record_sha256(file_path: Path, digest: str) -> None:
+    """ Save digest next to the file, valid until file size or mtime changes. """
+    stat = file_path.stat()
+    record = {"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    __sha256_record_path(file_path).write_text(json.dumps(record))
+
+
+def recorded_sha256(file_path: Path) -> Optional[str]:
+    """ Digest saved by record_sha256, None if missing or file changed. """
+    try:
+        record = json.loads(__sha256_record_path(file_path).read_text())
+        stat = file_path.stat()
+    except (OSError, ValueError):
+        return None
+    if record.get("size") != stat.st_size or record.get("mtime_ns") != stat.st_mtime_ns:
+        return None
+    return record.get("sha256")
+
+
+def archive_sha256(file_path: Path) -> str:
+    """ Recorded digest of file, compute and record it if unavailable. """
+    digest = recorded_sha256(file_path)
+    if digest is None:
+        digest = file_sha256(file_path)
+        record_sha256(file_path, digest)
+    return digest
+
+
+def verify_sha256(file_path: Path, sha256: str) -> None:
+    """ Raise if file digest mismatches. """
+    digest = archive_sha256(file_path)
+    if digest != sha256.lower():
+        raise Exception(f"Hash mismatch {file_path} expect={sha256} got={digest}")
+
+
+def link_file(src: Path, dst: Path) -> None:
+    """ Hardlink src to dst, fall back to reflink then copy. dst is replaced. """
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
         return
-    if file_path.exists():
+    except OSError:
+        pass
+    try:
+        __reflink(src, dst)
         return
-    resp = requests.get(url, stream=True)
-    total_length = resp.headers.get('content-length')
-    if total_length is not None:
-        total_length = int(total_length)
-    with open(file_path, "wb") as fs:
-        for data in tqdm(resp.iter_content(), total=total_length):
-            fs.write(data)
+    except (ImportError, OSError):
+        dst.unlink(missing_ok=True)
+    shutil.copy2(src, dst)
+
+
+def sync_file(src: Path, dst: Path, link: bool = False, digest: Optional[str] = None) -> bool:
+    """ Replace dst with src unless they have the same content, so mtime of
+    unchanged dst is kept. Return True if dst is replaced.
+
+    Args:
+        link: Hardlink src to dst if possible, otherwise copy.
+        digest: Optional sha256 of src, saves reading src.
+    """
+    if dst.is_file() and not dst.is_symlink():
+        src_stat, dst_stat = src.stat(), dst.stat()
+        if src_stat.st_size == dst_stat.st_size:
+            if os.path.samestat(src_stat, dst_stat):
+                return False
+            if digest is not None:
+                if file_sha256(dst) == digest:
+                    return False
+            elif filecmp.cmp(src, dst, shallow=False):
+                return False
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = dst.with_name(f".{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    if link:
+        link_file(src, tmp_path)
+    else:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+    return True
+
+
+def sync_tree(src_dir: Path, dst_dir: Path, link: bool = False) -> List[Path]:
+    """ Merge src_dir into dst_dir, only files with different content are
+    replaced. Return replaced files. """
+    replaced: List[Path] = []
+    for root, dirs, names in os.walk(src_dir):
+        for name in dirs + names:
+            src = Path(root, name)
+            dst = dst_dir / src.relative_to(src_dir)
+            if src.is_symlink():
+                if sync_symlink(os.readlink(src), dst):
+                    replaced.append(dst)
+            elif src.is_dir():
+                dst.mkdir(parents=True, exist_ok=True)
+            elif sync_file(src, dst, link):
+                replaced.append(dst)
+    logging.debug(f"Synced {src_dir} -> {dst_dir}, replaced {len(replaced)} files")
+    return replaced
+
+
+def sync_symlink(target: str, dst: Path) -> bool:
+    """ Point symlink dst to target, return True if dst is replaced. """
+    if dst.is_symlink() and os.readlink(dst) == target:
+        return False
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.is_symlink() or dst.is_file():
+        dst.unlink()
+    os.symlink(target, dst)
+    return True
+
+
+def __reflink(src: Path, dst: Path) -> None:
+    """ Copy-on-write clone, supported by btrfs, xfs and so on. """
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+class Downloader:
+    """ Download files through one HTTP session.
+
+    Connections are kept alive and reused by all downloads. Requests failed by
+    connection errors or server errors are retried with exponential backoff,
+    an interrupted transfer is retried by resuming from where it stopped.
+    """
+    def __init__(
+        self, pool_size: int = 10, retries: int = 3, backoff: float = 0.5,
+        timeout: float = 30, chunk_size: int = 1024 * 1024,
+        cache: Optional["DownloadCache"] = None, connections: int = 1
+    ) -> None:
+        """
+        Args:
+            pool_size: Max number of connections kept alive per host.
+            retries: Max number of retries of a download.
+            backoff: Retry delay is backoff * 2^(retry - 1) seconds.
+            timeout: Connect and read timeout in seconds.
+            chunk_size: Bytes per read of response body.
+            cache: Download cache looked up before downloading.
+            connections: Max number of connections of one download. Files are
+                split into byte ranges fetched at the same time if server
+                supports range requests.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.connections = connections
+        retry = Retry(
+            total=retries, backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        # Bodies must be bytes as sent, a compressed transfer decoded by
+        # requests mismatches Content-Length, sha256 and resume offsets.
+        self.session.headers["Accept-Encoding"] = "identity"
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> requests.Response:
+        """ Streamed GET request. """
+        return self.session.get(url, stream=True, headers=headers, timeout=self.timeout)
+
+    def download(
+        self, url: str, file_path: Path, dryrun: bool=False, sha256: Optional[str]=None,
+        connections: Optional[int]=None
+    ) -> None:
+        """ See download. """
+        logging.info(f"Download: {url} -> {file_path}")
+        if dryrun:
+            return
+        if file_path.exists():
+            if sha256:
+                verify_sha256(file_path, sha256)
+            return
+        if self.cache is not None and self.cache.get(url, file_path, sha256):
+            if sha256:
+                record_sha256(file_path, sha256)
+            return
+        if connections is None:
+            connections = self.connections
+        def download_once() -> str:
+            digest = None
+            if connections > 1:
+                digest = self.__download_segmented(url, file_path, connections)
+            if digest is None:
+                digest = self.__download(url, file_path)
+            return digest
+        digest = self.__retry(download_once)
+        if sha256 and digest != sha256.lower():
+            file_path.unlink()
+            raise Exception(f"Hash mismatch {url} expect={sha256} got={digest}")
+        record_sha256(file_path, digest)
+        if self.cache is not None:
+            self.cache.put(url, file_path, sha256)
+
+    def download_unpack(
+        self, url: str, file_path: Path, target_dir: Path, dryrun: bool=False,
+        sha256: Optional[str]=None, keep: bool=True
+    ) -> None:
+        """ See download_unpack. """
+        logging.info(f"Download and unpack: {url} -> {target_dir}")
+        if dryrun:
+            return
+        if file_path.exists() or not is_tarball(file_path):
+            self.download(url, file_path, sha256=sha256)
+            unpack(file_path, target_dir)
+            return
+        if self.cache is not None and self.cache.get(url, file_path, sha256):
+            if sha256:
+                record_sha256(file_path, sha256)
+            unpack(file_path, target_dir)
+            if not keep:
+                self.__discard(file_path)
+            return
+        if sha256 and _unpacked(file_path.name, target_dir, sha256.lower()):
+            logging.info(f"Skip download and unpack, {file_path.name} is unchanged")
+            return
+        # Archive file is required to fill cache.
+        tee_path = file_path if keep or self.cache is not None else None
+        target_dir.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(prefix=".unpack-", dir=target_dir))
+        try:
+            digest = self.__retry(self.__stream_unpack, url, tee_path, tmp_dir)
+            if sha256 and digest != sha256.lower():
+                if tee_path is not None:
+                    tee_path.unlink()
+                raise Exception(f"Hash mismatch {url} expect={sha256} got={digest}")
+            _commit_unpack(tmp_dir, file_path.name, target_dir, digest)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if tee_path is None:
+            return
+        record_sha256(file_path, digest)
+        if self.cache is not None:
+            self.cache.put(url, file_path, sha256)
+        if not keep:
+            self.__discard(file_path)
+
+    @staticmethod
+    def __discard(file_path: Path) -> None:
+        """ Remove archive and its digest record, the cached copy is kept. """
+        file_path.unlink()
+        file_path.with_name(file_path.name + ".sha256").unlink(missing_ok=True)
+
+    def __retry(self, func: Callable[..., str], *args: Any) -> str:
+        for attempt in range(self.retries):
+            try:
+                return func(*args)
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                # Failed requests are retried by session, retry transfers
+                # broken or stalled while reading the body here.
+                delay = self.backoff * (2 ** attempt)
+                logging.warning(f"Download interrupted err={e}, retry in {delay}s")
+                time.sleep(delay)
+        return func(*args)
+
+    def __stream_unpack(self, url: str, tee_path: Optional[Path], target_dir: Path) -> str:
+        """ Extract tarball while downloading, return sha256 of the archive. """
+        part_path = tee_path.with_name(tee_path.name + ".part") if tee_path is not None else None
+        with self.get(url) as resp:
+            resp.raise_for_status()
+            total_length = resp.headers.get('content-length')
+            if total_length is not None:
+                total_length = int(total_length)
+            # Drop entries extracted by a broken attempt.
+            for entry in target_dir.iterdir():
+                if entry.is_dir() and not entry.is_symlink():
+                    shutil.rmtree(entry)
+                else:
+                    entry.unlink()
+            start = time.monotonic()
+            with (open(part_path, "wb") if part_path is not None else contextlib.nullcontext() as fs,
+                  tqdm(total=total_length, unit="B", unit_scale=True) as bar):
+                reader = _ChunkReader(resp.iter_content(chunk_size=self.chunk_size), fs, bar)
+                with tarfile.open(fileobj=reader, mode="r|*") as tar:
+                    tar.extractall(target_dir, filter="data")
+                # Consume trailing padding, so digest covers the whole body.
+                reader.read()
+        elapsed = time.monotonic() - start
+        logging.info(f"Downloaded and unpacked {reader.received} bytes in {elapsed:.2f}s, "
+                     f"{reader.received / max(elapsed, 1e-6) / 1024 / 1024:.2f} MiB/s")
+        if total_length is not None and reader.received != total_length:
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Incomplete download {url}, got {reader.received} of {total_length} bytes")
+        if part_path is not None:
+            os.replace(part_path, tee_path)
+        return reader.digest.hexdigest()
+
+    def __download(self, url: str, file_path: Path) -> str:
+        """ Download to file_path, return sha256 computed while streaming. """
+        part_path = file_path.with_name(file_path.name + ".part")
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+        with self.get(url, headers) as resp:
+            if offset > 0 and resp.status_code == 416:
+                # The .part file does not match remote file, start over.
+                logging.warning(f"Unable to resume {part_path}, restart download")
+                part_path.unlink()
+                return self.__download(url, file_path)
+            resp.raise_for_status()
+            digest = hashlib.sha256()
+            if offset > 0 and resp.status_code == 206:
+                logging.info(f"Resume download from {offset} bytes")
+                with open(part_path, "rb") as fs:
+                    while data := fs.read(self.chunk_size):
+                        digest.update(data)
+            else:
+                # Server ignores Range header, start over.
+                offset = 0
+            total_length = resp.headers.get('content-length')
+            if total_length is not None:
+                total_length = int(total_length) + offset
+            received = 0
+            start = time.monotonic()
+            with (open(part_path, "ab" if offset > 0 else "wb") as fs,
+                  tqdm(total=total_length, initial=offset, unit="B", unit_scale=True) as bar):
+                for data in resp.iter_content(chunk_size=self.chunk_size):
+                    fs.write(data)
+                    digest.update(data)
+                    received += len(data)
+                    bar.update(len(data))
+        elapsed = time.monotonic() - start
+        logging.info(f"Downloaded {received} bytes in {elapsed:.2f}s, "
+                     f"{received / max(elapsed, 1e-6) / 1024 / 1024:.2f} MiB/s")
+        if total_length is not None and offset + received != total_length:
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Incomplete download {part_path}, got {offset + received} of {total_length} bytes")
+        os.replace(part_path, file_path)
+        return digest.hexdigest()
+
+    def __download_segmented(self, url: str, file_path: Path, connections: int) -> Optional[str]:
+        """ Download byte ranges at the same time into a preallocated file,
+        return sha256 or None if server does not support range requests. """
+        try:
+            resp = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            logging.debug(f"Skip segmented download, HEAD failed err={e}")
+            return None
+        total_length = int(resp.headers.get("content-length", 0))
+        if resp.headers.get("accept-ranges") != "bytes" or total_length < 2 * self.chunk_size:
+            return None
+        connections = min(connections, total_length // self.chunk_size)
+        segment = -(-total_length // connections)
+        ranges = [(begin, min(begin + segment, total_length) - 1)
+                  for begin in range(0, total_length, segment)]
+        # Not a contiguous prefix, keep it away from the resumable .part file.
+        seg_path = file_path.with_name(file_path.name + ".segments.part")
+        with open(seg_path, "wb") as fs:
+            fs.truncate(total_length)
+        start = time.monotonic()
+        try:
+            with (tqdm(total=total_length, unit="B", unit_scale=True) as bar,
+                  ThreadPoolExecutor(max_workers=len(ranges)) as executor):
+                futures = [executor.submit(self.__download_range, resp.url, seg_path, begin, end, bar)
+                           for begin, end in ranges]
+                for future in futures:
+                    future.result()
+        except BaseException:
+            seg_path.unlink(missing_ok=True)
+            raise
+        elapsed = time.monotonic() - start
+        logging.info(f"Downloaded {total_length} bytes with {len(ranges)} connections in "
+                     f"{elapsed:.2f}s, {total_length / max(elapsed, 1e-6) / 1024 / 1024:.2f} MiB/s")
+        os.replace(seg_path, file_path)
+        # Segments arrive out of order, hash the file after download.
+        return file_sha256(file_path, self.chunk_size)
+
+    def __download_range(self, url: str, seg_path: Path, begin: int, end: int, bar: tqdm) -> None:
+        with (self.get(url, {"Range": f"bytes={begin}-{end}"}) as resp,
+              open(seg_path, "r+b") as fs):
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise requests.exceptions.ChunkedEncodingError(
+                    f"Range request bytes={begin}-{end} ignored, status={resp.status_code}")
+            fs.seek(begin)
+            received = 0
+            for data in resp.iter_content(chunk_size=self.chunk_size):
+                fs.write(data)
+                received += len(data)
+                bar.update(len(data))
+        if received != end - begin + 1:
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Incomplete range bytes={begin}-{end}, got {received} bytes")
+
+
+class _ChunkReader:
+    """ Read-only file object over response chunks, bytes read are hashed and
+    written to an optional file. """
+    def __init__(self, chunks: Iterator[bytes], fs: Optional[BinaryIO], bar: tqdm) -> None:
+        self.digest = hashlib.sha256()
+        self.received = 0
+        self.__chunks = chunks
+        self.__fs = fs
+        self.__bar = bar
+        self.__buf = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self.__buf) < size:
+            data = next(self.__chunks, b"")
+            if not data:
+                break
+            self.digest.update(data)
+            if self.__fs is not None:
+                self.__fs.write(data)
+            self.received += len(data)
+            self.__bar.update(len(data))
+            self.__buf += data
+        if size < 0:
+            size = len(self.__buf)
+        data = bytes(self.__buf[:size])
+        del self.__buf[:size]
+        return data
+
+
+__default_downloader: Optional[Downloader] = None
+__default_downloader_lock = threading.Lock()
+
+
+def default_downloader() -> Downloader:
+    """ Downloader shared by downloads that do not specify one. """
+    global __default_downloader
+    with __default_downloader_lock:
+        if __default_downloader is None:
+            __default_downloader = Downloader()
+        return __default_downloader
+
+
+def download(
+    url: str, file_path: Path, dryrun: bool=False, downloader: Optional[Downloader]=None,
+    sha256: Optional[str]=None, connections: Optional[int]=None
+) -> None:
+    """ Download file from the url to file_path.
+
+    Data is streamed into <file_path>.part, which is renamed to file_path when
+    complete. A .part file left by an interrupted download is resumed with a
+    HTTP Range request if the server supports it.
+
+    Args:
+        downloader: Downloader to reuse connections, default_downloader() if
+            not provided.
+        sha256: Expected hex digest. Downloads are hashed while streaming and
+            fail on mismatch, the digest is recorded in <file_path>.sha256 so
+            existing files are verified without re-hashing.
+        connections: Split download into byte ranges fetched by this number of
+            connections, downloader's setting if not provided.
+    """
+    if downloader is None:
+        downloader = default_downloader()
+    downloader.download(url, file_path, dryrun, sha256, connections)
+
+
+def download_unpack(
+    url: str, file_path: Path, target_dir: Path, dryrun: bool=False,
+    downloader: Optional[Downloader]=None, sha256: Optional[str]=None, keep: bool=True
+) -> None:
+    """ Download tarball and extract it into target_dir while it downloads.
+
+    Falls back to download and unpack if file_path exists, is cached, or is
+    not a tarball.
+
+    Args:
+        file_path: Archive path, the stream is also written to it if keep or
+            downloader has a cache.
+        keep: Keep archive file after extraction.
+    """
+    if downloader is None:
+        downloader = default_downloader()
+    downloader.download_unpack(url, file_path, target_dir, dryrun, sha256, keep)
+
+
+def is_tarball(file_path: Path) -> bool:
+    return file_path.name.endswith(
+        (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz"))
 
 
 def unpack(package_path: Path, target_dir: Path, dryrun: bool=False) -> None:
+    """ Extract archive into target_dir, skipped if unchanged since last unpack.
+
+    A stamp file in target_dir records archive digest and extracted files. The
+    archive is extracted into a temporary directory, then its top level entries
+    replace the ones in target_dir, so an interrupted unpack is never trusted.
+    """
     logging.info(f"Unpack: {package_path} -> {target_dir}")
     if dryrun:
         return
-    shutil.unpack_archive(package_path, target_dir)
+    digest = archive_sha256(package_path)
+    if _unpacked(package_path.name, target_dir, digest):
+        logging.info(f"Skip unpack, {package_path.name} is unchanged")
+        return
+    target_dir.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".unpack-", dir=target_dir))
+    try:
+        shutil.unpack_archive(package_path, tmp_dir)
+        _commit_unpack(tmp_dir, package_path.name, target_dir, digest)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def dir_size(path: Path) -> int:
+    """ Total bytes of files under path, symlinks are not followed. """
+    if not path.is_dir():
+        return path.stat().st_size if path.exists() else 0
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def source_digest(src_dir: Path) -> str:
+    """ Digest of source tree.
+
+    Archive digest if src_dir is extracted by unpack, otherwise digest of
+    paths, sizes and contents of all files in src_dir, so it is the same for
+    copies and checkouts of the same sources, whatever their mtimes.
+    """
+    stamp = _source_stamp(src_dir)
+    if stamp is not None:
+        return f"sha256:{stamp.get('sha256')}"
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = Path(root, name)
+            rel_path = file_path.relative_to(src_dir).as_posix()
+            try:
+                if file_path.is_symlink():
+                    item = f"link\0{os.readlink(file_path)}"
+                else:
+                    item = f"{file_path.stat().st_size}\0{file_sha256(file_path)}"
+            except OSError:
+                continue
+            digest.update(f"{rel_path}\0{item}\n".encode())
+    return f"tree:{digest.hexdigest()}"
+
+
+def source_size(src_dir: Path) -> Optional[int]:
+    """ Total bytes of files extracted into src_dir, recorded by unpack. None
+    if src_dir is not extracted by unpack. """
+    stamp = _source_stamp(src_dir)
+    return stamp.get("size") if stamp is not None else None
+
+
+def _source_stamp(src_dir: Path) -> Optional[Dict[str, Any]]:
+    """ Unpack stamp of the archive src_dir is extracted from, if any. """
+    for stamp_path in src_dir.parent.glob(".*.unpacked"):
+        try:
+            stamp = json.loads(stamp_path.read_text())
+        except (OSError, ValueError):
+            continue
+        if src_dir.name in stamp.get("entries", []):
+            return stamp
+    return None
+
+
+def _unpack_stamp_path(package_name: str, target_dir: Path) -> Path:
+    return target_dir / f".{package_name}.unpacked"
+
+
+def _unpacked(package_name: str, target_dir: Path, digest: str) -> bool:
+    """ Check if archive with digest is extracted into target_dir. """
+    try:
+        stamp = json.loads(_unpack_stamp_path(package_name, target_dir).read_text())
+    except (OSError, ValueError):
+        return False
+    return (stamp.get("sha256") == digest and
+            all((target_dir / entry).exists() for entry in stamp.get("entries", [])))
+
+
+def _commit_unpack(tmp_dir: Path, package_name: str, target_dir: Path, digest: str) -> None:
+    """ Move entries extracted into tmp_dir to target_dir, then write stamp. """
+    stamp_path = _unpack_stamp_path(package_name, target_dir)
+    # Invalidate stamp first, an interrupted swap must not be trusted.
+    stamp_path.unlink(missing_ok=True)
+    entries = sorted(os.listdir(tmp_dir))
+    files = [Path(root, name).relative_to(tmp_dir).as_posix()
+             for root, _, names in os.walk(tmp_dir) for name in names]
+    size = dir_size(tmp_dir)
+    trash_dir = Path(tempfile.mkdtemp(prefix=".trash-", dir=target_dir))
+    try:
+        for entry in entries:
+            dst = target_dir / entry
+            if dst.exists() or dst.is_symlink():
+                os.replace(dst, trash_dir / entry)
+            os.replace(tmp_dir / entry, dst)
+    finally:
+        shutil.rmtree(trash_dir, ignore_errors=True)
+    stamp = {"sha256": digest, "entries": entries, "files": sorted(files), "size": size}
+    stamp_path.write_text(json.dumps(stamp, indent=1))
+
+
+__install_prefix: contextvars.ContextVar[Optional[Path]] = contextvars.ContextVar(
+    "install_prefix", default=None)
+
+
+def install_prefix(default: Path) -> Path:
+    """ Prefix that Package.install should install into.
+
+    Returns default unless the install is redirected, for instance captured
+    into an artifact cache. Toolsets should always install into it.
+    """
+    prefix = __install_prefix.get()
+    return default if prefix is None else prefix
+
+
+@contextlib.contextmanager
+def redirect_install(prefix: Path) -> Iterator[Path]:
+    """ Redirect install_prefix in current thread. """
+    token = __install_prefix.set(prefix)
+    try:
+        yield prefix
+    finally:
+        __install_prefix.reset(token)
+
+
+class CmdResult:
+    """ Exit status and resource usage of a command run by run_cmd.
+
+    Usage covers the command and its descendants, zero where wait4 is not
+    supported, like on Windows.
+
+    On Linux, peak_rss is the peak total resident memory of the command and
+    its descendants running at the same time, sampled from /proc, or
+    ru_maxrss of the largest process if higher than parent_rss. Elsewhere it
+    is ru_maxrss of the largest process, which may be the high-water mark of
+    the Python process, inherited across fork and exec, if not higher than
+    parent_rss.
+    """
+    def __init__(self, cmd: str, returncode: int, wall_time: float) -> None:
+        self.cmd = cmd
+        self.returncode = returncode
+        # Seconds.
+        self.wall_time = wall_time
+        self.user_time = 0.0
+        self.sys_time = 0.0
+        # Bytes, peak resident memory, see above.
+        self.peak_rss = 0
+        # Bytes, peak resident memory of the Python process when the command
+        # started.
+        self.parent_rss = 0
+        # Bytes read from and written to storage.
+        self.read_bytes = 0
+        self.write_bytes = 0
+        # Last part of output.
+        self.tail = ""
+        # Log file holding full output, None if output went to console.
+        self.log_path: Optional[Path] = None
+
+    def __repr__(self) -> str:
+        return f"CmdResult(cmd={self.cmd!r}, {self.summary()})"
+
+    def summary(self) -> str:
+        return (f"exit={self.returncode} wall={self.wall_time:.2f}s user={self.user_time:.2f}s "
+                f"sys={self.sys_time:.2f}s maxrss={_format_size(self.peak_rss)} "
+                f"read={_format_size(self.read_bytes)} write={_format_size(self.write_bytes)}")
+
+
+def _format_size(size: float) -> str:
+    if size < 1024:
+        return f"{int(size)}B"
+    for unit in ("KiB", "MiB", "GiB"):
+        size /= 1024
+        if size < 1024:
+            break
+    return f"{size:.1f}{unit}"
+
+
+class ResourceUsage:
+    """ Resources used by commands run by run_cmd. """
+    def __init__(self) -> None:
+        self.results: List[CmdResult] = []
+        # Max peak resident memory of commands, in bytes.
+        self.peak_rss = 0
+
+    def add(self, result: CmdResult) -> None:
+        self.results.append(result)
+        self.peak_rss = max(self.peak_rss, result.peak_rss)
+
+
+__usage: contextvars.ContextVar[Optional[ResourceUsage]] = contextvars.ContextVar(
+    "usage", default=None)
+
+
+@contextlib.contextmanager
+def track_usage() -> Iterator[ResourceUsage]:
+    """ Collect resources used by run_cmd in current thread. """
+    usage = ResourceUsage()
+    token = __usage.set(usage)
+    try:
+        yield usage
+    finally:
+        __usage.reset(token)
+
+
+__output_log: contextvars.ContextVar[Optional[Path]] = contextvars.ContextVar(
+    "output_log", default=None)
+
+
+@contextlib.contextmanager
+def capture_output(log_path: Path) -> Iterator[Path]:
+    """ Write output of run_cmd in current thread to log_path instead of
+    console. Console only shows progress of long commands, and full output of
+    failed ones. """
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    log_path.write_bytes(b"")
+    token = __output_log.set(log_path)
+    try:
+        yield log_path
+    finally:
+        __output_log.reset(token)
+
+
+class JobServer:
+    """ GNU make compatible jobserver limiting jobs of all commands run by
+    run_cmd, across packages built at the same time.
+
+    Tokens are bytes in a named pipe exported to commands by MAKEFLAGS, so
+    make >= 4.2, and ninja >= 1.13 with auth="fifo", take tokens from the
+    same pool instead of starting their own jobs. run_cmd takes one token for
+    each command, as the implicit job of the command. Do not pass -j or
+    --parallel to build tools taking tokens, see parallel_jobs. On platforms
+    without named pipes, only commands of run_cmd in the same process are
+    limited.
+    """
+    def __init__(self, jobs: Optional[int] = None, auth: str = "pipe") -> None:
+        """
+        Args:
+            jobs: Max number of jobs, default to cpu count.
+            auth: "pipe" passes an inherited file descriptor, supported by
+                make >= 4.2. "fifo" exports the path of named pipe, supported by
+                make >= 4.4 and ninja >= 1.13, but rejected by older make,
+                including make of CMake try_compile.
+        """
+        if auth not in ("fifo", "pipe"):
+            raise Exception(f"Unknown jobserver auth={auth}, expect fifo or pipe")
+        self.jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+        self.auth = auth
+        self.fifo_path: Optional[Path] = None
+        self.running = False
+        self.__init_local()
+
+    def __init_local(self) -> None:
+        """ States not shared with other processes. """
+        self.__lock = threading.Lock()
+        self.__semaphore = threading.BoundedSemaphore(self.jobs)
+        self.__fd: Optional[int] = None
+        self.__fd_pid = 0
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Processes of the process backend open the named pipe by path.
+        return {"jobs": self.jobs, "auth": self.auth, "fifo_path": self.fifo_path,
+                "running": self.running}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.__init_local()
+
+    def start(self) -> None:
+        """ Create the named pipe filled with tokens. """
+        self.running = True
+        if not hasattr(os, "mkfifo"):
+            logging.info(f"Jobserver jobs={self.jobs}, limiting run_cmd only")
+            return
+        fifo_path = Path(tempfile.mkdtemp(prefix="exccpkg-jobserver-")) / "fifo"
+        os.mkfifo(fifo_path, 0o600)
+        self.fifo_path = fifo_path
+        os.write(self.__open(), b"+" * self.jobs)
+        logging.info(f"Jobserver jobs={self.jobs} fifo={fifo_path}")
+
+    def stop(self) -> None:
+        """ Remove the named pipe. """
+        self.running = False
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+        if self.fifo_path is not None:
+            shutil.rmtree(self.fifo_path.parent, ignore_errors=True)
+            self.fifo_path = None
+
+    def env(self) -> Dict[str, str]:
+        """ Environment variables exporting the jobserver to commands. """
+        if self.fifo_path is None:
+            return dict()
+        # Drop jobserver of an outer make, if any.
+        flags = [flag for flag in os.environ.get("MAKEFLAGS", "").split()
+                 if not flag.startswith(("-j", "--jobserver"))]
+        if self.auth == "fifo":
+            auth = f"fifo:{self.fifo_path}"
+        else:
+            fd = self.__open()
+            auth = f"{fd},{fd}"
+        flags += [f"-j{self.jobs}", f"--jobserver-auth={auth}"]
+        return {"MAKEFLAGS": " ".join(flags)}
+
+    def pass_fds(self) -> Tuple[int, ...]:
+        """ File descriptors commands should inherit. """
+        if self.fifo_path is None or self.auth != "pipe":
+            return ()
+        return (self.__open(),)
+
+    def acquire(self) -> bytes:
+        """ Take a token, blocking until one is available. """
+        if self.fifo_path is None:
+            self.__semaphore.acquire()
+            return b"+"
+        fd = self.__open()
+        while True:
+            try:
+                token = os.read(fd, 1)
+            except InterruptedError:
+                continue
+            if token:
+                return token
+
+    def release(self, token: bytes) -> None:
+        """ Return a token taken by acquire. """
+        if self.fifo_path is None:
+            self.__semaphore.release()
+            return
+        os.write(self.__open(), token)
+
+    @contextlib.contextmanager
+    def token(self) -> Iterator[bytes]:
+        token = self.acquire()
+        try:
+            yield token
+        finally:
+            self.release(token)
+
+    def __open(self) -> int:
+        with self.__lock:
+            if self.__fd is None or self.__fd_pid != os.getpid():
+                # Read-write, so reads block instead of hitting EOF when no
+                # one else opens the pipe.
+                self.__fd = os.open(self.fifo_path, os.O_RDWR)
+                self.__fd_pid = os.getpid()
+            return self.__fd
+
+
+__jobserver: Optional[JobServer] = None
+
+
+def jobserver() -> Optional[JobServer]:
+    """ Jobserver used by run_cmd, None if not enabled. """
+    return __jobserver
+
+
+@contextlib.contextmanager
+def use_jobserver(server: Optional[JobServer]) -> Iterator[Optional[JobServer]]:
+    """ Let run_cmd of current process use server, start and stop it if not
+    running yet. """
+    global __jobserver
+    prev = __jobserver
+    owner = server is not None and not server.running
+    if owner:
+        server.start()
+    __jobserver = server
+    try:
+        yield server
+    finally:
+        __jobserver = prev
+        if owner:
+            server.stop()
+
+
+def parallel_jobs(generator: str) -> Optional[int]:
+    """ Number of jobs build tool should start, None if it takes tokens from
+    the jobserver instead.
+
+    Args:
+        generator: CMake generator, or name of build tool. Makefile generators
+            take tokens by either auth, make >= 4.4 is required for "fifo".
+            Ninja generators take tokens by "fifo" only, ninja >= 1.13 is
+            required. Other generators never take tokens.
+    """
+    server = __jobserver
+    if server is None or server.fifo_path is None:
+        return os.cpu_count()
+    name = generator.lower()
+    if "makefiles" in name or name in ("make", "gmake", "mingw32-make"):
+        return None
+    if "ninja" in name and server.auth == "fifo":
+        return None
+    # Not limited by the jobserver beyond the token of the command itself.
+    return server.jobs
 
 
 def cmake_prepare_build_dir(build_dir: Path, rebuild: bool = True, dryrun: bool=False) -> None:
@@ -76,20 +991,243 @@ def cmake_prepare_build_dir(build_dir: Path, rebuild: bool = True, dryrun: bool=
     mkdirp(build_dir)
 
 
-def run_cmd(cmd: str, dryrun: bool=False) -> None:
-    segments = cmd.split("\n")
-    segments = [seg.strip(" ") for seg in segments]
-    formatted_cmd = " ".join(segments)
-    logging.info(f"Execute: {os.getcwd()}$ {formatted_cmd}")
-    if dryrun:
-        return
+_OUTPUT_CHUNK_SIZE = 64 * 1024
+# Bytes of output kept for error reports.
+_OUTPUT_TAIL_SIZE = 16 * 1024
+# Seconds between progress logs of a command writing to log file.
+_OUTPUT_PROGRESS_INTERVAL = 10.0
+# Seconds between samples of memory of commands.
+_RSS_SAMPLE_INTERVAL = 0.2
+
+
+class _RssSampler:
+    """ Sample resident memory of a process tree from /proc in a thread.
+
+    Kept peaks are total VmRSS of processes alive at the same time, and
+    VmHWM of the largest process, which covers spikes between samples.
+    """
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+        self.peak_rss = 0
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name=f"rss-{pid}", daemon=True)
+        self.__thread.start()
+
+    @staticmethod
+    def supported() -> bool:
+        return os.path.exists(f"/proc/{os.getpid()}/status")
+
+    def stop(self) -> int:
+        """ Stop sampling, return peak in bytes. """
+        self.__stopped.set()
+        self.__thread.join()
+        return self.peak_rss
+
+    def __run(self) -> None:
+        while True:
+            self.__sample()
+            if self.__stopped.wait(_RSS_SAMPLE_INTERVAL):
+                return
+
+    def __sample(self) -> None:
+        total = 0
+        pids = [self.pid]
+        while pids:
+            pid = pids.pop()
+            rss, hwm = self.__read_status(pid)
+            total += rss
+            self.peak_rss = max(self.peak_rss, hwm)
+            pids.extend(self.__children(pid))
+        self.peak_rss = max(self.peak_rss, total)
+
+    @staticmethod
+    def __read_status(pid: int) -> Tuple[int, int]:
+        """ VmRSS and VmHWM in bytes, zero for exited processes. """
+        rss, hwm = 0, 0
+        try:
+            with open(f"/proc/{pid}/status", "rb") as fs:
+                for line in fs:
+                    if line.startswith(b"VmRSS:"):
+                        rss = int(line.split()[1]) * 1024
+                    elif line.startswith(b"VmHWM:"):
+                        hwm = int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return rss, hwm
+
+    @staticmethod
+    def __children(pid: int) -> List[int]:
+        children: List[int] = []
+        try:
+            for tid in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{tid}/children", "rb") as fs:
+                    children.extend(int(child) for child in fs.read().split())
+        except (OSError, ValueError):
+            pass
+        return children
+
+
+def __run(
+    args: Union[str, List[str]], cmd: str, env: Optional[Mapping[str, str]],
+    cwd: Optional[Path], pass_fds: Tuple[int, ...] = ()
+) -> CmdResult:
+    """ Run args, in shell if it is a string. cmd is the printable command. """
+    start = time.monotonic()
     # Use shell=True since commands are provided by project author, security check is useless.
     proc = subprocess.Popen(
-        formatted_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-        shell=True, env=os.environ)
-    for line in iter(proc.stdout.readline, b""):
-        print(line.decode(), end="")
-    returncode = proc.wait()
-    if returncode != 0:
-        raise Exception(f"Failed to execute cmd=\"{formatted_cmd}\" exit={returncode}")
+        args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        shell=isinstance(args, str), env=env, cwd=cwd, pass_fds=pass_fds)
+    sampler = _RssSampler(proc.pid) if hasattr(os, "wait4") and _RssSampler.supported() else None
+    log_path = __output_log.get()
+    try:
+        if log_path is None:
+            tail = __pipe_to_console(proc)
+            offset = 0
+        else:
+            tail, offset = __pipe_to_log(proc, cmd, log_path, start)
+        result = __wait(proc, cmd, start, sampler)
+    finally:
+        if sampler is not None:
+            sampler.stop()
+    result.tail = tail.decode(errors="replace")
+    result.log_path = log_path
+    if result.returncode != 0 and log_path is not None:
+        __print_log(log_path, offset)
+    return result
+
+
+def __pipe_to_console(proc: subprocess.Popen) -> bytes:
+    """ Copy output to console in large chunks, return the tail. """
+    tail = b""
+    sys.stdout.flush()
+    out = getattr(sys.stdout, "buffer", None)
+    while data := os.read(proc.stdout.fileno(), _OUTPUT_CHUNK_SIZE):
+        if out is None:
+            sys.stdout.write(data.decode(errors="replace"))
+        else:
+            out.write(data)
+        # Flush so output of long commands shows up in time.
+        sys.stdout.flush()
+        tail = (tail + data)[-_OUTPUT_TAIL_SIZE:]
+    proc.stdout.close()
+    return tail
+
+
+def __pipe_to_log(
+    proc: subprocess.Popen, cmd: str, log_path: Path, start: float
+) -> Tuple[bytes, int]:
+    """ Append output to log file, log progress at intervals. Return the tail
+    and where output starts in the log file. """
+    tail = b""
+    lines = 0
+    reported = start
+    with open(log_path, "ab") as fs:
+        offset = fs.tell()
+        fs.write(f"$ {cmd}\n".encode())
+        while data := os.read(proc.stdout.fileno(), _OUTPUT_CHUNK_SIZE):
+            fs.write(data)
+            tail = (tail + data)[-_OUTPUT_TAIL_SIZE:]
+            lines += data.count(b"\n")
+            now = time.monotonic()
+            if now - reported >= _OUTPUT_PROGRESS_INTERVAL:
+                reported = now
+                last_line = tail.rstrip().rsplit(b"\n", 1)[-1].decode(errors="replace")
+                logging.info(f"Running {now - start:.0f}s lines={lines} log={log_path}: {last_line[:160]}")
+    proc.stdout.close()
+    return tail, offset
+
+
+def __print_log(log_path: Path, offset: int) -> None:
+    """ Print log file from offset to console. """
+    sys.stdout.flush()
+    with open(log_path, "rb") as fs:
+        fs.seek(offset)
+        out = getattr(sys.stdout, "buffer", None)
+        while data := fs.read(_OUTPUT_CHUNK_SIZE):
+            if out is None:
+                sys.stdout.write(data.decode(errors="replace"))
+            else:
+                out.write(data)
+    sys.stdout.flush()
+
+
+def __wait(
+    proc: subprocess.Popen, cmd: str, start: float, sampler: Optional[_RssSampler]
+) -> CmdResult:
+    if not hasattr(os, "wait4"):
+        returncode = proc.wait()
+        return CmdResult(cmd, returncode, time.monotonic() - start)
+    import resource
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere.
+    unit = 1 if platform.system() == "Darwin" else 1024
+    # No less than what the child inherited, the high-water mark only grows.
+    parent_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    # Reap the child by wait4 to get resource usage of it and its descendants.
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    result = CmdResult(cmd, proc.returncode, time.monotonic() - start)
+    result.user_time = rusage.ru_utime
+    result.sys_time = rusage.ru_stime
+    result.parent_rss = parent_rss
+    result.peak_rss = rusage.ru_maxrss * unit
+    if sampler is not None:
+        # ru_maxrss not above parent_rss may be inherited from this process.
+        sampled = sampler.stop()
+        result.peak_rss = max(sampled, result.peak_rss if result.peak_rss > parent_rss else 0)
+    # Counted in 512 bytes blocks.
+    result.read_bytes = rusage.ru_inblock * 512
+    result.write_bytes = rusage.ru_oublock * 512
+    return result
+
+
+def run_cmd(
+    cmd: Union[str, Sequence[Union[str, Path]]], dryrun: bool=False,
+    env: Optional[Mapping[str, str]] = None, cwd: Optional[Path] = None
+) -> Optional[CmdResult]:
+    """ Run command. Return its exit status and resource usage, None if
+    dryrun. Raise if exit status is not zero.
+
+    Output goes to console, or log file of capture_output.
+
+    The result is also logged, with the record in extra field cmd_result, and
+    collected by track_usage.
+
+    Args:
+        cmd: Shell command, lines are joined by spaces. Or a list of program
+            and arguments, run without shell, so arguments need no quoting.
+        env: Environment variables overriding os.environ for this command.
+        cwd: Working directory, default to current one.
+    """
+    if isinstance(cmd, str):
+        segments = cmd.split("\n")
+        segments = [seg.strip(" ") for seg in segments]
+        args: Union[str, List[str]] = " ".join(segments)
+        formatted_cmd = args
+    else:
+        args = [os.fspath(arg) for arg in cmd]
+        formatted_cmd = shlex.join(args)
+    logging.info(f"Execute: {cwd if cwd is not None else os.getcwd()}$ {formatted_cmd}")
+    if dryrun:
+        return None
+    server = __jobserver
+    # Layer overrides on os.environ instead of copying it, None inherits it.
+    layers = [layer for layer in (env, server.env() if server is not None else None) if layer]
+    cmd_env = collections.ChainMap(*layers, os.environ) if layers else None
+    with trace.span("run_cmd", cmd=formatted_cmd):
+        if server is None:
+            result = __run(args, formatted_cmd, cmd_env, cwd)
+        else:
+            with server.token():
+                result = __run(args, formatted_cmd, cmd_env, cwd, server.pass_fds())
+        usage = __usage.get()
+        if usage is not None:
+            usage.add(result)
+        if result.returncode != 0:
+            log = "" if result.log_path is None else f" log={result.log_path}"
+            logging.error(f"Failed cmd=\"{formatted_cmd}\" {result.summary()}{log}",
+                          extra={"cmd_result": result})
+            raise Exception(f"Failed to execute cmd=\"{formatted_cmd}\" exit={result.returncode}")
+        logging.info(f"Finished cmd=\"{formatted_cmd}\" {result.summary()}",
+                     extra={"cmd_result": result})
+        return result
 
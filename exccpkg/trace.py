@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import contextvars
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+
+class Tracer:
+    """ Spans of grab, build, install and commands.
+
+    Exported as Chrome trace event JSON, viewable in Perfetto or
+    chrome://tracing. Timestamps are of the monotonic clock shared by all
+    processes, so spans recorded by other processes can be merged by extend.
+    """
+    def __init__(self) -> None:
+        self.pid = os.getpid()
+        self.__origin = time.perf_counter_ns()
+        self.__events: List[Dict[str, Any]] = []
+        self.__threads: Set[Tuple[int, int]] = set()
+        self.__lock = threading.Lock()
+
+    def add(self, name: str, start_ns: int, end_ns: int, args: Dict[str, Any]) -> None:
+        """ Record a span of current thread. """
+        pid, tid = os.getpid(), threading.get_native_id()
+        event = {"name": name, "ph": "X", "ts": start_ns / 1000, "dur": (end_ns - start_ns) / 1000,
+                 "pid": pid, "tid": tid, "args": args}
+        with self.__lock:
+            if (pid, tid) not in self.__threads:
+                self.__threads.add((pid, tid))
+                self.__events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                                      "args": {"name": threading.current_thread().name}})
+            self.__events.append(event)
+
+    def events(self) -> List[Dict[str, Any]]:
+        with self.__lock:
+            return list(self.__events)
+
+    def extend(self, events: List[Dict[str, Any]]) -> None:
+        """ Merge events recorded by another tracer. """
+        with self.__lock:
+            self.__events.extend(events)
+
+    def export(self, path: Path) -> None:
+        """ Write Chrome trace event JSON, timestamps start from creation of
+        this tracer. """
+        origin = self.__origin / 1000
+        events = [dict(event, ts=event["ts"] - origin) if "ts" in event else event
+                  for event in self.events()]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+        os.replace(tmp_path, path)
+
+    def summary(self, top: int = 10) -> str:
+        """ Text table of the slowest spans. """
+        spans = sorted((event for event in self.events() if event["ph"] == "X"),
+                       key=lambda event: event["dur"], reverse=True)[:top]
+        lines = [f"Top {len(spans)} slowest steps:"]
+        for event in spans:
+            args = event["args"]
+            detail = " ".join(str(args[key]) for key in ("pkg", "cmd") if key in args)
+            failed = " (failed)" if args.get("failed") else ""
+            lines.append(f"{event['dur'] / 1e6:10.2f}s  {event['name']:<8} {detail[:120]}{failed}")
+        return "\n".join(lines)
+
+
+__tracer: Optional[Tracer] = None
+__package: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar("package", default={})
+
+
+def current() -> Optional[Tracer]:
+    """ Tracer recording spans of current process, None if not tracing. """
+    tracer = __tracer
+    # A forked process does not record into the copy of its parent's tracer.
+    if tracer is None or tracer.pid != os.getpid():
+        return None
+    return tracer
+
+
+@contextlib.contextmanager
+def use(tracer: Optional[Tracer]) -> Iterator[Optional[Tracer]]:
+    """ Record spans of current process into tracer. """
+    global __tracer
+    prev = __tracer
+    __tracer = tracer
+    try:
+        yield tracer
+    finally:
+        __tracer = prev
+
+
+@contextlib.contextmanager
+def record(path: Path, top: int = 10) -> Iterator[Tracer]:
+    """ Record spans into a new tracer, export to path and log the slowest
+    ones on exit, even if failed. """
+    tracer = Tracer()
+    try:
+        with use(tracer):
+            yield tracer
+    finally:
+        tracer.export(path)
+        logging.info(f"Trace saved to {path}\n{tracer.summary(top)}")
+
+
+@contextlib.contextmanager
+def package(pkg_id: str, depth: int) -> Iterator[None]:
+    """ Tag spans of current thread with package. """
+    token = __package.set({"pkg": pkg_id, "depth": depth})
+    try:
+        yield
+    finally:
+        __package.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    """ Record a span if tracing, tagged with args and current package. """
+    tracer = current()
+    if tracer is None:
+        yield
+        return
+    start = time.perf_counter_ns()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        args = {**__package.get(), **args}
+        if failed:
+            args["failed"] = True
+        tracer.add(name, start, time.perf_counter_ns(), args)